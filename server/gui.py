@@ -1,32 +1,88 @@
 """Web server for the typing GUI."""
 import base64
+import functools
+import hashlib
+import math
 import os
 import random
 import string
 
 import cats
 from gui_files.common_server import Server, route, sendto, start
-from gui_files import multiplayer
+from gui_files import batch_distance, edit_distance, game_engine, leaderboard_integrity, multiplayer, worker_pool
+from gui_files.lru_cache import LRUCache
+from gui_files.paragraphs import Corpus
+from gui_files.scoring import ScoringSession
+from gui_files.word_snapshot import load_dictionary
 
 PORT = 31415
 DEFAULT_SERVER = 'https://cats.cs61a.org'
 GUI_FOLDER = "gui_files/"
 PARAGRAPH_PATH = "./data/sample_paragraphs.txt"
-WORDS_LIST = cats.lines_from_file('data/words.txt')
+PARAGRAPHS = Corpus(PARAGRAPH_PATH)
+WORDS_LIST, WORD_INDEX = load_dictionary('data/words.txt', 'data/words.snapshot')
 WORDS_SET = set(WORDS_LIST)
-LETTER_SETS = [(w, set(w)) for w in WORDS_LIST]
 SIMILARITY_LIMIT = 2
+BOUNDED_DIFFS = {
+    cats.feline_fixes: edit_distance.bounded_edit_distance,
+    cats.sphinx_swap: edit_distance.bounded_substitutions,
+}
+VECTORIZE_THRESHOLD = 256
+# Words and candidates used to check that cats.autocorrect works with a diff
+# function before its bounded equivalent is used in its place.
+AUTOCORRECT_SAMPLES = [('wrod', ['word', 'wood', 'ward']), ('inside', ['outside', 'inside']), ('zzzz', ['word'])]
+CORRECTIONS = LRUCache(int(os.environ.get("AUTOCORRECT_CACHE_SIZE", 10000)))
+AUTOCORRECT_WORKERS = int(os.environ.get("AUTOCORRECT_WORKERS", 0))
+AUTOCORRECT_TIMEOUT = float(os.environ.get("AUTOCORRECT_TIMEOUT", 2))
+AUTOCORRECT_BATCH_LIMIT = 200
+SCORING_SESSIONS = LRUCache(int(os.environ.get("SCORING_SESSIONS", 10000)), ttl=3600)
+
+
+# Paragraphs used to check that choose and about in cats work.
+SAMPLE_PARAGRAPHS = ['Cute Dog!', 'That is a cat.', 'Nice pup!']
+
+
+def probe(check):
+    """Cache the result of CHECK, which checks functions in cats on samples,
+    for each set of arguments. cats is not reloaded while the server runs, so
+    the result does not change. A check that raises counts as failing."""
+    results = {}
+
+    @functools.wraps(check)
+    def wrapped(*args):
+        if args not in results:
+            try:
+                results[args] = bool(check(*args))
+            except BaseException:
+                results[args] = False
+        return results[args]
+    return wrapped
 
 
 @route
 def request_paragraph(topics=None):
-    """Return a random paragraph."""
+    """Return a random paragraph.
+
+    Once choose and about in cats are implemented, the paragraph is found
+    with the index in PARAGRAPHS instead of by searching every paragraph.
+    """
+    if paragraphs_implemented():
+        return PARAGRAPHS.choose_random(topics)
     paragraphs = cats.lines_from_file(PARAGRAPH_PATH)
     random.shuffle(paragraphs)
     select = cats.about(topics) if topics else lambda x: True
     return cats.choose(paragraphs, select, 0)
 
 
+@probe
+def paragraphs_implemented():
+    """Whether choose and about in cats give the right answers for
+    SAMPLE_PARAGRAPHS."""
+    return cats.choose(SAMPLE_PARAGRAPHS, cats.about(['dog', 'pup']), 1) == 'Nice pup!' \
+        and cats.choose(SAMPLE_PARAGRAPHS, cats.about(['cat']), 1) == '' \
+        and cats.choose(SAMPLE_PARAGRAPHS, lambda p: True, 2) == 'Nice pup!'
+
+
 @route
 def analyze(prompted_text, typed_text, start_time, end_time):
     """Return [wpm, accuracy]."""
@@ -36,33 +92,162 @@ def analyze(prompted_text, typed_text, start_time, end_time):
     }
 
 
-def similar(w, v, n):
-    """Whether W intersect V contains at least |W|-N and |V|-N elements."""
-    intersect = len(w.intersection(v))
-    return intersect >= len(w) - n and intersect >= len(v) - n
+@route
+def analyze_incremental(session, keep, added, start_time, end_time, prompt=None):
+    """Like analyze, but for scoring session SESSION, which is only sent the
+    typed words that changed: it keeps the first KEEP words it has, followed
+    by the words in ADDED. Starts a new session if PROMPT is given.
+
+    Returns None if the caller should fall back to analyze, because the
+    session has expired or is out of date.
+    """
+    scores = update_session(("analyze", session), keep, added, prompt)
+    if not scores:
+        return None
+    return {
+        "wpm": scores.wpm(end_time - start_time),
+        "accuracy": scores.accuracy()
+    }
+
+
+@probe
+def scoring_implemented():
+    """Whether wpm, accuracy and report_progress in cats agree with
+    ScoringSession on a sample, so that sessions can stand in for them."""
+    prompt, typed = 'Cute Dog. I say!', 'Cute dog. I'
+    session = ScoringSession(prompt)
+    session.update(0, typed.split())
+    sent = []
+    return math.isclose(cats.wpm(typed, 7), session.wpm(7)) \
+        and math.isclose(cats.accuracy(typed, prompt), session.accuracy()) \
+        and cats.report_progress(typed.split(), prompt.split(), 0, sent.append) == session.progress() \
+        and sent == [{"id": 0, "progress": session.progress()}]
+
+
+def update_session(key, keep, added, prompt=None):
+    """Update the scoring session stored under KEY, or a new one for PROMPT if
+    it is given, and return it. Returns None if it cannot be updated."""
+    if not scoring_implemented():
+        return None
+    if prompt is not None:
+        SCORING_SESSIONS.put(key, ScoringSession(prompt))
+    session = SCORING_SESSIONS.get(key)
+    if session is None or not session.update(keep, added):
+        return None
+    return session
 
 
 @route
 def autocorrect(word=""):
     """Call autocorrect using the best score function available."""
-    raw_word = word
+    return autocorrect_batch([word])[0]
+
+
+@route
+def autocorrect_batch(words=()):
+    """Autocorrect each of WORDS in order, in a worker process if
+    AUTOCORRECT_WORKERS is set. Words are left as they are if correcting them
+    takes longer than AUTOCORRECT_TIMEOUT seconds, and so are any beyond the
+    first AUTOCORRECT_BATCH_LIMIT.
+
+    The autocorrect cache is kept in this process, so only words that are not
+    cached are sent to a worker, and the corrections it returns are cached
+    here.
+    """
+    words = list(words)
+    batch, rest = words[:AUTOCORRECT_BATCH_LIMIT], words[AUTOCORRECT_BATCH_LIMIT:]
+    corrections = {}
+    for raw_word in batch:
+        if raw_word not in corrections:
+            corrections[raw_word] = known_correction(raw_word)
+    misses = [raw_word for raw_word, corrected in corrections.items() if corrected is None]
+    if misses:
+        results = worker_pool.run(correct_words, [misses], AUTOCORRECT_TIMEOUT, [(w, None) for w in misses])
+        for raw_word, (corrected, entry) in zip(misses, results):
+            corrections[raw_word] = corrected
+            if entry:
+                CORRECTIONS.put(*entry)
+    return [corrections[raw_word] for raw_word in batch] + rest
+
+
+def diff_fns():
+    """The diff functions to try, in order."""
+    return [cats.final_diff, cats.feline_fixes, cats.sphinx_swap]
+
+
+def known_correction(raw_word):
+    """Return RAW_WORD if it needs no correction, or its cached correction.
+    Returns None if it must be corrected."""
     word = cats.lower(cats.remove_punctuation(raw_word))
     if word in WORDS_SET or word == '':
         return raw_word
+    guess = CORRECTIONS.get_first([(fn.__name__, word) for fn in diff_fns()])
+    return None if guess is None else reformat(guess, raw_word)
+
+
+def correct_words(words):
+    """Autocorrect each of WORDS, which are distinct and not cached, sharing
+    the candidate search between words with the same letters. Returns a
+    (correction, cache entry) pair for each word, as correct does."""
+    candidates_by_letters = {}
+    results = []
+    for raw_word in words:
+        word = cats.lower(cats.remove_punctuation(raw_word))
+        # Heuristically choose candidate words to score.
+        letters = frozenset(word)
+        if letters not in candidates_by_letters:
+            candidates_by_letters[letters] = WORD_INDEX.similar(letters, SIMILARITY_LIMIT)
+        results.append(correct(word, raw_word, candidates_by_letters[letters], diff_fns()))
+    return results
+
+
+@route
+def autocorrect_cache_stats():
+    """Return hit, miss and eviction counts for the autocorrect cache."""
+    return CORRECTIONS.stats()
+
 
-    # Heuristically choose candidate words to score.
-    letters = set(word)
-    candidates = [w for w, s in LETTER_SETS if similar(s, letters, SIMILARITY_LIMIT)]
+def correct(word, raw_word, candidates, diff_fns):
+    """Return the closest of CANDIDATES to WORD, the normalized form of
+    RAW_WORD, reformatted to match RAW_WORD, along with a (key, guess) entry
+    that caches the guess under the first of DIFF_FNS that succeeds. The entry
+    is None if none of them do."""
+    if not candidates:
+        return raw_word, None
 
     # Try various diff functions until one doesn't raise an exception.
-    for fn in [cats.final_diff, cats.feline_fixes, cats.sphinx_swap]:
+    for fn in diff_fns:
         try:
-            guess = cats.autocorrect(word, candidates, fn, SIMILARITY_LIMIT)
-            return reformat(guess, raw_word)
+            guess = score_candidates(word, candidates, fn)
+            corrected = reformat(guess, raw_word)
         except BaseException:
-            pass
+            continue
+        return corrected, ((fn.__name__, word), guess)
+
+    return raw_word, None
+
 
-    return raw_word
+def score_candidates(word, candidates, fn):
+    """Return the element of CANDIDATES closest to WORD under diff function FN.
+
+    Once cats.autocorrect with a diff function that has a bounded equivalent
+    gives the right answers on AUTOCORRECT_SAMPLES, the candidates are scored
+    with the bounded version instead, all at once if there are many of them.
+    """
+    if fn not in BOUNDED_DIFFS or not autocorrect_implemented(fn):
+        return cats.autocorrect(word, candidates, fn, SIMILARITY_LIMIT)
+    if len(candidates) >= VECTORIZE_THRESHOLD:
+        return batch_distance.autocorrect(word, candidates, BOUNDED_DIFFS[fn], SIMILARITY_LIMIT)
+    return edit_distance.autocorrect(word, candidates, BOUNDED_DIFFS[fn], SIMILARITY_LIMIT)
+
+
+@probe
+def autocorrect_implemented(fn):
+    """Whether cats.autocorrect with diff function FN agrees with its bounded
+    equivalent on AUTOCORRECT_SAMPLES."""
+    return all(cats.autocorrect(word, candidates, fn, SIMILARITY_LIMIT)
+               == edit_distance.autocorrect(word, candidates, BOUNDED_DIFFS[fn], SIMILARITY_LIMIT)
+               for word, candidates in AUTOCORRECT_SAMPLES)
 
 
 def reformat(word, raw_word):
@@ -108,32 +293,82 @@ def report_progress(id, typed, prompt):
 
 
 @route
-def fastest_words(prompt, targets):
-    """Return a list of word_speed values describing the game."""
+def report_progress_incremental(id, keep, added, prompt=None):
+    """Like report_progress, but only sent the typed words that changed, as in
+    analyze_incremental. The session is kept under the player's ID.
+
+    Returns None if the caller should fall back to report_progress.
+    """
+    session = update_session(("progress", id), keep, added, prompt)
+    if not session:
+        return None
+    progress = session.progress()
+    sendto(Server.set_progress)({"id": id, "progress": progress})
+    return progress
+
+
+# A game with a tie, used to check that the game functions in cats work.
+SAMPLE_TIMES, SAMPLE_WORDS = [[0, 2, 3], [0, 1, 3], [0, 2, 3]], ['a', 'b']
+SAMPLE_FASTEST = [['b'], ['a'], []]
+
+
+@route
+def fastest_words(prompt, targets, game=None):
+    """Return a list of word_speed values describing GAME, or the current game
+    of TARGETS if it is not given.
+
+    Once the game functions in cats are implemented, the game is computed
+    with the array-backed versions in game_engine instead.
+    """
     words = prompt.split()
-    progress = Server.request_all_progress(targets=targets)
-    start_times = [p[0][1] for p in progress]
-    times_per_player = [[p[1] - s for p in ps] for s, ps in zip(start_times, progress)]
-    game = cats.time_per_word(times_per_player, words)
-    return cats.fastest_words(game)
+    progress = Server.request_progress_columns(targets=targets, game=game)
+    times_per_player = [times for _, times in progress]
+    if game_functions_implemented():
+        return game_engine.fastest_words(game_engine.time_per_word(times_per_player, words))
+    times_per_player = [[t - times[0] for t in times] for times in times_per_player]
+    return cats.fastest_words(cats.time_per_word(times_per_player, words))
+
+
+@probe
+def game_functions_implemented():
+    """Whether time_per_word and fastest_words in cats give the right answer
+    for SAMPLE_TIMES."""
+    return cats.fastest_words(cats.time_per_word(SAMPLE_TIMES, SAMPLE_WORDS)) == SAMPLE_FASTEST
 
 
 multiplayer.create_multiplayer_server()
+worker_pool.start_pool(AUTOCORRECT_WORKERS)
+leaderboard_integrity.start_captcha_pool()
 
 ###############
 # Favicons #
 ###############
 
 
+def load_favicons(folder):
+    """Map a digest of each favicon in FOLDER, used as its ETag, to its data
+    URL."""
+    favicons = {}
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), "rb") as f:
+            data = f.read()
+        etag = hashlib.sha256(data).hexdigest()[:16]
+        favicons[etag] = "data:image/png;base64," + base64.b64encode(data).decode("utf-8")
+    return favicons
+
+
+FAVICONS = load_favicons(os.path.join(GUI_FOLDER, "favicons"))
+FAVICON_ETAGS = sorted(FAVICONS)
+
+
 @route
-def favicon():
-    favicon_folder = os.path.join(GUI_FOLDER, "favicons")
-    favicons = os.listdir(favicon_folder)
-    path = os.path.join(favicon_folder, random.choice(favicons))
-    with open(path, "rb") as f:
-        data = f.read()
-    image_b64 = base64.b64encode(data).decode("utf-8")
-    return "data:image/png;base64," + image_b64
+def favicon(cached=()):
+    """Return a random favicon and its ETag. The image is left out if its ETag
+    is among the CACHED ETags of favicons the client already has."""
+    etag = random.choice(FAVICON_ETAGS)
+    if etag in cached:
+        return {"etag": etag}
+    return {"etag": etag, "image": FAVICONS[etag]}
 
 
 if __name__ == "__main__" or "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
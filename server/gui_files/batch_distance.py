@@ -0,0 +1,79 @@
+"""Diff functions that score one word against many candidates at once.
+
+These compute the same differences as the bounded diff functions in
+edit_distance, but for a whole list of candidates in a single pass over a
+padded matrix of character codes. NumPy is optional: without it, autocorrect
+falls back to scoring candidates one at a time.
+"""
+from gui_files import edit_distance
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def encode(words):
+    """Return a matrix of the character codes of WORDS, padded with zeros, and
+    an array of their lengths."""
+    width = max(1, max(map(len, words)))
+    codes = np.array(words, dtype="U{}".format(width)).view(np.uint32).reshape(len(words), width)
+    lengths = np.fromiter(map(len, words), dtype=np.intp, count=len(words))
+    return codes, lengths
+
+
+def edit_distances(start, goals):
+    """The edit distance from START to each of GOALS, as in feline_fixes."""
+    codes, lengths = encode(goals)
+    cols = np.arange(codes.shape[1] + 1)
+    prev = np.tile(cols, (len(goals), 1))
+    for i, c in enumerate(start, 1):
+        curr = np.empty_like(prev)
+        curr[:, 0] = i
+        np.minimum(prev[:, :-1] + (codes != ord(c)), prev[:, 1:] + 1, out=curr[:, 1:])
+        # An addition after column j - 1 costs one more than column j - 1.
+        prev = np.minimum.accumulate(curr - cols, axis=1) + cols
+    return prev[np.arange(len(goals)), lengths]
+
+
+def substitutions(start, goals):
+    """The number of substitutions needed to turn START into each of GOALS,
+    plus the difference in their lengths, as in sphinx_swap."""
+    codes, lengths = encode(goals)
+    width = codes.shape[1]
+    query = np.zeros(width, dtype=np.uint32)
+    prefix = start[:width]
+    if prefix:
+        query[:len(prefix)] = np.array([prefix]).view(np.uint32)
+    overlap = np.minimum(lengths, len(start))
+    mismatched = (codes != query) & (np.arange(width) < overlap[:, None])
+    return mismatched.sum(axis=1) + np.abs(lengths - len(start))
+
+
+VECTORIZED = {
+    edit_distance.bounded_edit_distance: edit_distances,
+    edit_distance.bounded_substitutions: substitutions,
+}
+
+
+def autocorrect(user_word, valid_words, diff_function, limit):
+    """Return the first element of VALID_WORDS with the smallest difference
+    from USER_WORD, or USER_WORD if that difference is greater than LIMIT.
+
+    DIFF_FUNCTION is one of the bounded diff functions in edit_distance. The
+    result is the same as edit_distance.autocorrect, which is used instead if
+    NumPy is not installed.
+    """
+    if np is None or diff_function not in VECTORIZED:
+        return edit_distance.autocorrect(user_word, valid_words, diff_function, limit)
+    if user_word in valid_words:
+        return user_word
+    # Both differences are at least the difference in lengths.
+    lengths = np.fromiter(map(len, valid_words), dtype=np.intp, count=len(valid_words))
+    close = np.flatnonzero(np.abs(lengths - len(user_word)) <= limit)
+    if not len(close):
+        return user_word
+    words = [valid_words[i] for i in close]
+    diffs = VECTORIZED[diff_function](user_word, words)
+    best = int(np.argmin(diffs))
+    return words[best] if diffs[best] <= limit else user_word
@@ -0,0 +1,100 @@
+"""Rendered captcha images, stored on disk so they can be served without
+rendering.
+
+Each word has CAPTCHA_VARIANTS renderings, and a random one is served each
+time. A rendering is replaced by a fresh one once it has been served
+CAPTCHA_VARIANT_MAX_SERVES times by a process, or is CAPTCHA_VARIANT_MAX_AGE
+old, so that the set of images for a word keeps changing. Captchas are taken
+from the cache by the producer in leaderboard_integrity, so the re-rendering
+happens there rather than in requests. Rendering the whole cache ahead of time
+takes a while; run
+
+    python -m gui_files.captcha_cache
+
+from the server directory to do so. Missing renderings are otherwise created
+the first time they are needed.
+"""
+import base64
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+CACHE_DIR = os.environ.get("CAPTCHA_CACHE_DIR", "data/captchas")
+CAPTCHA_VARIANTS = 4
+CAPTCHA_VARIANT_MAX_SERVES = int(os.environ.get("CAPTCHA_VARIANT_MAX_SERVES", 10))
+CAPTCHA_VARIANT_MAX_AGE = timedelta(hours=float(os.environ.get("CAPTCHA_VARIANT_MAX_AGE_HOURS", 24)))
+
+# The number of times each (word, variant) has been served by this process
+# since it was last rendered here.
+serves = {}
+
+
+def render(word):
+    """The PNG image of a new captcha for WORD."""
+    from claptcha import Claptcha
+    c = Claptcha(word, "gui_files/FreeMono.ttf", margin=(20, 10))
+    return c.bytes[1].getvalue()
+
+
+def variant_path(word, variant):
+    # Hex-encoded, since some words contain characters such as apostrophes.
+    return os.path.join(CACHE_DIR, "{}.{}.png".format(word.encode("utf-8").hex(), variant))
+
+
+def store(word, variant):
+    """Render VARIANT of WORD and write it to the cache. Return the image."""
+    image = render(word)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temporary file first, so that other processes never read a
+    # partially written image.
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        os.replace(temp_path, variant_path(word, variant))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return image
+
+
+def load(word, variant):
+    """Return the image of VARIANT of WORD, rendering it if it is missing or
+    too old. The images are left to the operating system's page cache rather
+    than kept in memory by each server process."""
+    path = variant_path(word, variant)
+    try:
+        if time.time() - os.stat(path).st_mtime <= CAPTCHA_VARIANT_MAX_AGE.total_seconds():
+            with open(path, "rb") as f:
+                return f.read()
+    except FileNotFoundError:
+        pass
+    return store(word, variant)
+
+
+def get_captcha(word):
+    """Return the data URL of a random rendering of WORD, replacing the
+    rendering first if it has been served too often."""
+    variant = random.randrange(CAPTCHA_VARIANTS)
+    count = serves.get((word, variant), 0)
+    if count >= CAPTCHA_VARIANT_MAX_SERVES:
+        image, count = store(word, variant), 0
+    else:
+        image = load(word, variant)
+    serves[(word, variant)] = count + 1
+    return "data:image/png;base64," + base64.b64encode(image).decode("utf-8")
+
+
+def build_cache(words):
+    """Render every variant of each of WORDS that is missing or too old."""
+    for word in words:
+        for variant in range(CAPTCHA_VARIANTS):
+            load(word, variant)
+
+
+if __name__ == "__main__":
+    from gui_files.leaderboard_integrity import CAPTCHA_WORDS
+    build_cache(CAPTCHA_WORDS)
+    print("Rendered captchas for {} words in {}".format(len(CAPTCHA_WORDS), CACHE_DIR))
@@ -0,0 +1,79 @@
+"""Bounded diff functions for scoring autocorrect candidates.
+
+Each diff function returns the exact difference between START and GOAL when it
+is at most LIMIT, and some value greater than LIMIT otherwise, stopping as soon
+as the difference is known to exceed LIMIT. This matches the behavior that
+cats.autocorrect relies on from sphinx_swap and feline_fixes.
+"""
+
+
+def bounded_substitutions(start, goal, limit):
+    """The number of substitutions needed to turn START into GOAL, plus the
+    difference in their lengths, as in sphinx_swap.
+
+    >>> bounded_substitutions('roses', 'arose', 10)
+    5
+    >>> bounded_substitutions('rose', 'hello', 2) > 2
+    True
+    """
+    diff = abs(len(start) - len(goal))
+    for a, b in zip(start, goal):
+        if diff > limit:
+            break
+        diff += a != b
+    return diff
+
+
+def bounded_edit_distance(start, goal, limit):
+    """The minimum number of additions, removals and substitutions needed to
+    turn START into GOAL, as in feline_fixes.
+
+    Only the cells of the dynamic programming table within LIMIT of the
+    diagonal are computed, and the computation stops as soon as a whole row
+    exceeds LIMIT.
+
+    >>> bounded_edit_distance('ckiteus', 'kittens', 10)
+    3
+    >>> bounded_edit_distance('roses', 'arose', 1) > 1
+    True
+    """
+    m, n = len(start), len(goal)
+    over = limit + 1
+    if abs(m - n) > limit:
+        return over
+    prev = [min(j, over) for j in range(n + 1)]
+    for i in range(1, m + 1):
+        curr = [min(i, over)] + [over] * n
+        a = start[i - 1]
+        for j in range(max(1, i - limit), min(n, i + limit) + 1):
+            curr[j] = min(prev[j - 1] + (a != goal[j - 1]), prev[j] + 1, curr[j - 1] + 1, over)
+        if min(curr) > limit:
+            return over
+        prev = curr
+    return prev[n]
+
+
+def autocorrect(user_word, valid_words, diff_function, limit):
+    """Return the first element of VALID_WORDS with the smallest difference
+    from USER_WORD, or USER_WORD if that difference is greater than LIMIT.
+
+    Equivalent to cats.autocorrect for a bounded DIFF_FUNCTION, but each
+    candidate is only scored against the best difference found so far.
+
+    >>> autocorrect('inside', ['inside', 'outside'], bounded_edit_distance, 2)
+    'inside'
+    >>> autocorrect('cul', ['cult', 'cue', 'cull'], bounded_edit_distance, 2)
+    'cult'
+    >>> autocorrect('zzz', ['cult', 'cue'], bounded_edit_distance, 2)
+    'zzz'
+    """
+    if user_word in valid_words:
+        return user_word
+    best_word, best_diff = user_word, limit + 1
+    for word in valid_words:
+        diff = diff_function(user_word, word, best_diff - 1)
+        if diff < best_diff:
+            best_word, best_diff = word, diff
+            if diff == 0:
+                break
+    return best_word
@@ -0,0 +1,41 @@
+"""Array-backed games, for finding which player typed each word fastest.
+
+A game here is a pair of its words and a players-by-words matrix of how long
+each player took to type each word. The results match cats.time_per_word and
+cats.fastest_words, including breaking ties toward the lower player index.
+NumPy is optional: without it, the same results are computed with loops.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def time_per_word(times_per_player, words):
+    """Return a game of WORDS, given the time each player started followed by
+    the time they finished each word. Times are measured from each player's
+    start before they are compared, as the GUI does."""
+    assert all(len(times) == len(words) + 1 for times in times_per_player), \
+        'each player needs a start time and a time for each word'
+    if np is None:
+        relative = [[t - times[0] for t in times] for times in times_per_player]
+        return words, [[times[i + 1] - times[i] for i in range(len(words))] for times in relative]
+    times = np.array(times_per_player, dtype=float).reshape(len(times_per_player), len(words) + 1)
+    return words, np.diff(times - times[:, :1], axis=1)
+
+
+def fastest_words(game):
+    """Return a list of the words each player typed fastest."""
+    words, times = game
+    fastest = [[] for _ in range(len(times))]
+    if not len(times):
+        return fastest
+    if np is None:
+        players = [min(range(len(times)), key=lambda p: times[p][i]) for i in range(len(words))]
+    else:
+        # argmin returns the first minimum, which is the lowest player index.
+        players = np.argmin(times, axis=0).tolist()
+    for word, player in zip(words, players):
+        fastest[player].append(word)
+    return fastest
+
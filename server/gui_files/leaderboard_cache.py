@@ -0,0 +1,76 @@
+"""An in-process copy of the top of the leaderboard."""
+import time
+from threading import Lock
+
+
+class LeaderboardCache:
+    """The SIZE best (name, user, wpm) entries of the leaderboard, as returned
+    by LOAD(SIZE) in descending order of wpm.
+
+    Writes made through this process update the copy in place. Writes made by
+    other processes are picked up when the copy is more than MAX_AGE seconds
+    old.
+
+    >>> rows = [("a", 1, 90.0), ("b", 2, 80.0), ("c", 3, 70.0)]
+    >>> cache = LeaderboardCache(2, 60, lambda n: rows[:n])
+    >>> cache.top()
+    [('a', 1, 90.0), ('b', 2, 80.0)]
+    >>> cache.threshold(3)
+    80.0
+    >>> cache.record("c", 3, 85.0)
+    >>> cache.record("a", 1, 60.0)
+    >>> cache.top()
+    [('a', 1, 90.0), ('c', 3, 85.0)]
+    >>> cache.threshold(3)
+    85.0
+    """
+
+    def __init__(self, size, max_age, load):
+        self.size, self.max_age, self.load = size, max_age, load
+        self.entries = None
+        self.loaded = 0
+        self.lock = Lock()
+
+    def top(self):
+        """The best entries, reloaded if they are missing or stale."""
+        with self.lock:
+            if self.entries is None or time.time() - self.loaded > self.max_age:
+                self.entries = [tuple(row) for row in self.load(self.size)]
+                self.loaded = time.time()
+            return list(self.entries)
+
+    def contains(self, user):
+        """Whether USER has one of the best entries."""
+        return any(entry_user == user for _, entry_user, _ in self.top())
+
+    def threshold(self, user):
+        """The lowest wpm that would place USER on the leaderboard without
+        lowering their existing entry."""
+        entries = self.top()
+        threshold = entries[-1][2] if len(entries) >= self.size else 0
+        for _, entry_user, wpm in entries:
+            if entry_user == user:
+                threshold = max(threshold, wpm)
+        # A user who is not among the best entries of a full leaderboard has
+        # at most the lowest of them, so the threshold already accounts for it.
+        return threshold
+
+    def record(self, name, user, wpm):
+        """Reflect that USER scored WPM under NAME, which replaces their entry
+        only if it is higher."""
+        with self.lock:
+            if self.entries is None:
+                return
+            if any(entry_user == user and wpm <= best for _, entry_user, best in self.entries):
+                return
+            entries = [entry for entry in self.entries if entry[1] != user]
+            entries.append((name, user, wpm))
+            entries.sort(key=lambda entry: entry[2], reverse=True)
+            self.entries = entries[:self.size]
+
+    def rename(self, user, name):
+        """Reflect that USER's entry is now under NAME."""
+        with self.lock:
+            if self.entries is not None:
+                self.entries = [(name if entry_user == user else entry_name, entry_user, wpm)
+                                for entry_name, entry_user, wpm in self.entries]
@@ -1,22 +1,53 @@
-import base64
+import atexit
+import hashlib
 import json
+import multiprocessing
 import os
 import random
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
-from queue import Queue
-from threading import Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 
 import cats
+from gui_files import captcha_cache
+from gui_files.lru_cache import LRUCache
 
 fernet = None
 
 COMMON_WORDS_SET = set(cats.lines_from_file('data/common_words.txt'))
-CAPTCHA_QUEUE_LEN = 200
 CAPTCHA_LENGTH = 10
 CAPTCHA_WORD_LEN = 6
-
-captcha_queue = Queue()
+CAPTCHA_WORDS = sorted(x for x in COMMON_WORDS_SET if len(x) < CAPTCHA_LENGTH)
+
+# The producer refills the queue up to CAPTCHA_QUEUE_LEN once it drops below
+# CAPTCHA_LOW_WATERMARK, rendering in the pool started by start_captcha_pool,
+# or in its own thread if there is none. get_captcha_urls waits at most
+# CAPTCHA_TIMEOUT seconds.
+# After a failure, the producer waits before trying again, doubling the wait
+# after each failure in a row up to CAPTCHA_MAX_BACKOFF seconds.
+CAPTCHA_QUEUE_LEN = 200
+CAPTCHA_LOW_WATERMARK = 50
+CAPTCHA_WORKERS = int(os.environ.get("CAPTCHA_WORKERS", 1))
+CAPTCHA_TIMEOUT = float(os.environ.get("CAPTCHA_TIMEOUT", 2))
+CAPTCHA_MAX_BACKOFF = 300
+
+captcha_queue = Queue(CAPTCHA_QUEUE_LEN)
+captcha_wanted = Event()
+captcha_metrics = {"rendered": 0, "renderSeconds": 0.0, "maxRenderSeconds": 0.0, "failures": 0, "shortChallenges": 0}
+captcha_lock = Lock()
+captcha_pool = None
+captcha_producer = None
+# Set once the interpreter starts exiting, after which the producer stops.
+exiting = Event()
+atexit.register(exiting.set)
+
+# Payloads of tokens that have been decrypted and verified, keyed by a digest of
+# the token. Tokens that fail verification are never stored.
+verified_tokens = LRUCache(int(os.environ.get("TOKEN_CACHE_SIZE", 10000)),
+                           ttl=float(os.environ.get("TOKEN_CACHE_TTL", 300)))
 
 
 def require_fernet(f):
@@ -41,22 +72,41 @@ def token_writer(f):
     return wrapped
 
 
+@require_fernet
+def verify_token(token):
+    """Return the payload of TOKEN, or None if this server did not issue it."""
+    from cryptography.fernet import InvalidToken
+    try:
+        return json.loads(fernet.decrypt(token.encode("utf-8")))
+    except (TypeError, InvalidToken):
+        return None
+
+
 def token_reader(fail):
     def decorator(f):
         @wraps(f)
-        @require_fernet
         def wrapped(*, token, **kwargs):
-            from cryptography.fernet import InvalidToken
             if not token:
                 return fail
+            key = hashlib.sha256(token.encode("utf-8")).digest()
+            payload = verified_tokens.get(key)
+            if payload is None:
+                payload = verify_token(token)
+                if payload is None:
+                    return fail
+                verified_tokens.put(key, payload)
             try:
-                return f(token=json.loads(fernet.decrypt(token.encode("utf-8"))), **kwargs)
-            except (TypeError, InvalidToken):
+                return f(token=payload, **kwargs)
+            except TypeError:
                 return fail
         return wrapped
     return decorator
 
 
+def token_cache_stats():
+    return verified_tokens.stats()
+
+
 @token_writer
 def create_wpm_authorization(user, wpm):
     return {
@@ -86,26 +136,103 @@ def decode_challenge(token):
     return token["user"], token["words"], token["startTime"]
 
 
-def populate_captcha_queue():
-    while captcha_queue.qsize() < CAPTCHA_QUEUE_LEN:
-        captcha_queue.put(generate_captcha())
+def start_captcha_pool(num_workers=CAPTCHA_WORKERS):
+    """Start NUM_WORKERS processes for rendering captchas, where processes can
+    be forked. Call this before the server starts handling requests, so that
+    the workers are forked from a process with no other threads."""
+    global captcha_pool
+    if captcha_pool is None and num_workers > 0 and "fork" in multiprocessing.get_all_start_methods():
+        # Reseed each worker, or they would all render the same words.
+        captcha_pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"),
+                                           initializer=random.seed)
+        for future in [captcha_pool.submit(int) for _ in range(num_workers)]:
+            future.result()
+
+
+def start_captcha_producer():
+    """Start the thread that keeps captcha_queue filled, if it is not running."""
+    global captcha_producer
+    with captcha_lock:
+        if captcha_producer is None:
+            captcha_producer = Thread(target=produce_captchas, args=[captcha_pool], daemon=True)
+            captcha_producer.start()
+            captcha_wanted.set()
+
+
+def produce_captchas(pool):
+    failures = 0  # in a row
+    while not exiting.is_set():
+        captcha_wanted.wait()
+        captcha_wanted.clear()
+        try:
+            needed = CAPTCHA_QUEUE_LEN - captcha_queue.qsize()
+            renders = pool.map(render_captcha, range(needed)) if pool else map(render_captcha, range(needed))
+            for captcha, seconds in renders:
+                with captcha_lock:
+                    captcha_metrics["rendered"] += 1
+                    captcha_metrics["renderSeconds"] += seconds
+                    captcha_metrics["maxRenderSeconds"] = max(captcha_metrics["maxRenderSeconds"], seconds)
+                # Only this thread adds to the queue, so there is room.
+                captcha_queue.put(captcha)
+            failures = 0
+        except BrokenProcessPool as e:
+            # A worker died, so render in this thread from now on.
+            print("Captcha workers failed, rendering in the server instead: {}".format(e))
+            pool = None
+            captcha_wanted.set()
+        except Exception as e:
+            if exiting.is_set():
+                return
+            failures += 1
+            backoff = min(2 ** (failures - 1), CAPTCHA_MAX_BACKOFF)
+            print("Failed to render captchas, retrying in {} seconds: {}".format(backoff, e))
+            with captcha_lock:
+                captcha_metrics["failures"] += 1
+            time.sleep(backoff)
+            captcha_wanted.set()
+
+
+def render_captcha(_):
+    """Return a new captcha and how many seconds it took to render."""
+    start = time.time()
+    captcha = generate_captcha()
+    return captcha, time.time() - start
+
+
+def captcha_stats():
+    """The number of queued captchas, along with rendering metrics."""
+    with captcha_lock:
+        stats = dict(captcha_metrics)
+    stats["depth"] = captcha_queue.qsize()
+    stats["meanRenderSeconds"] = stats["renderSeconds"] / stats["rendered"] if stats["rendered"] else 0
+    return stats
 
 
 def generate_captcha():
-    from claptcha import Claptcha
-    word = random.choice([x for x in COMMON_WORDS_SET if len(x) < CAPTCHA_LENGTH])
-    c = Claptcha(word, "gui_files/FreeMono.ttf", margin=(20, 10))
-    image_b64 = base64.b64encode(c.bytes[1].getvalue()).decode("utf-8")
-    return "data:image/png;base64," + image_b64, word
-
-
-def get_captcha_urls(num_words=CAPTCHA_LENGTH):
-    Thread(target=populate_captcha_queue).start()
-
-    images, words = [], []
-    for _ in range(num_words):
-        image, word = captcha_queue.get()
-        images.append(image)
-        words.append(word)
-
+    word = random.choice(CAPTCHA_WORDS)
+    return captcha_cache.get_captcha(word), word
+
+
+def get_captcha_urls(num_words=CAPTCHA_LENGTH, timeout=CAPTCHA_TIMEOUT):
+    """Return the images and words of up to NUM_WORDS new captchas, waiting
+    at most TIMEOUT seconds for them. Captchas are never served twice, so
+    fewer are returned if too few are rendered in time."""
+    start_captcha_producer()
+    deadline = time.time() + timeout
+
+    captchas = []
+    while len(captchas) < num_words:
+        if captcha_queue.qsize() < CAPTCHA_LOW_WATERMARK:
+            captcha_wanted.set()
+        try:
+            captchas.append(captcha_queue.get(timeout=max(0, deadline - time.time())))
+        except Empty:
+            break
+
+    if len(captchas) < num_words:
+        with captcha_lock:
+            captcha_metrics["shortChallenges"] += 1
+
+    images = [image for image, _ in captchas]
+    words = [word for _, word in captchas]
     return images, words
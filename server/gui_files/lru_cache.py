@@ -0,0 +1,83 @@
+"""A bounded least-recently-used cache that keeps hit and miss statistics."""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """Maps keys to values, evicting the least recently used entry once more
+    than CAPACITY entries are stored. If TTL is given, entries also expire TTL
+    seconds after they are put.
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)
+    >>> 'b' in cache
+    False
+    >>> cache.get('b', 'missing')
+    'missing'
+    >>> sorted(cache.stats().items())
+    [('capacity', 2), ('evictions', 1), ('expirations', 0), ('hits', 1), ('misses', 1), ('size', 2)]
+    """
+
+    def __init__(self, capacity, ttl=None):
+        assert capacity > 0, 'capacity must be positive'
+        self.capacity, self.ttl = capacity, ttl
+        self.entries = OrderedDict()  # key -> (value, expiry time or None)
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the value for KEY, or DEFAULT if it is not cached."""
+        return self.get_first([key], default)
+
+    def get_first(self, keys, default=None):
+        """Return the value of the first of KEYS that is cached, or DEFAULT if
+        none of them are. Counts as a single hit or miss."""
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    value, expiry = self.entries[key]
+                    if expiry is not None and time.time() >= expiry:
+                        del self.entries[key]
+                        self.expirations += 1
+                        continue
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Cache VALUE for KEY, evicting the least recently used entry if full."""
+        with self.lock:
+            self.entries[key] = (value, None if self.ttl is None else time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries, keeping the statistics."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        return {
+            "capacity": self.capacity,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
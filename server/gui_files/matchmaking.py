@@ -0,0 +1,64 @@
+"""Queues of players waiting for a multiplayer game to start."""
+from heapq import heappop, heappush
+from itertools import count
+
+
+class Lobby:
+    """Players waiting to be matched into a game together.
+
+    A game starts when MAX_PLAYERS are waiting, or when at least MIN_PLAYERS are
+    waiting and one of them has waited for MAX_WAIT. Players who have not
+    polled for longer than QUEUE_TIMEOUT are removed. Poll times and join
+    times are kept in heaps, so each poll takes amortized logarithmic time in
+    the number of players; entries for players who have left or polled again
+    are discarded when they reach the top.
+    """
+
+    def __init__(self, min_players, max_players, queue_timeout, max_wait):
+        self.min_players, self.max_players = min_players, max_players
+        self.queue_timeout, self.max_wait = queue_timeout, max_wait
+        self.players = {}  # id -> [most recent poll time, join time], in join order
+        self.polls = []  # heap of (poll time, tiebreaker, id)
+        self.joins = []  # heap of (join time, tiebreaker, id)
+        self.tiebreaker = count()
+
+    def __len__(self):
+        return len(self.players)
+
+    def poll(self, id, now):
+        """Record that player ID is waiting at time NOW. Return the list of
+        players in a new game if one should start, or None otherwise."""
+        if id not in self.players:
+            self.players[id] = [None, now]
+            heappush(self.joins, (now, next(self.tiebreaker), id))
+        self.players[id][0] = now
+        heappush(self.polls, (now, next(self.tiebreaker), id))
+
+        self.expire(now)
+
+        if len(self.players) >= self.max_players or \
+                now - self.earliest_join() >= self.max_wait and len(self.players) >= self.min_players:
+            players = list(self.players)
+            self.clear()
+            return players
+
+    def expire(self, now):
+        """Remove players who have not polled within the timeout of NOW."""
+        while self.polls and now - self.polls[0][0] > self.queue_timeout:
+            recent_time, _, player = heappop(self.polls)
+            if player in self.players and self.players[player][0] == recent_time:
+                del self.players[player]
+
+    def earliest_join(self):
+        """The earliest join time of any waiting player."""
+        while True:
+            join_time, _, player = self.joins[0]
+            if player in self.players and self.players[player][1] == join_time:
+                return join_time
+            heappop(self.joins)
+
+    def clear(self):
+        """Remove all waiting players."""
+        self.players.clear()
+        self.polls.clear()
+        self.joins.clear()
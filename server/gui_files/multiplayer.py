@@ -1,28 +1,45 @@
+import os
 import time
-from collections import namedtuple, defaultdict
-from datetime import datetime, timedelta
+from datetime import timedelta
 from random import randrange
 
 import cats
 from gui_files.common_server import route, forward_to_server, server_only
-from gui_files.db import connect_db, setup_db
+from gui_files.db_pool import connect_db, dialect, pool_stats
 from gui_files.leaderboard_integrity import get_authorized_limit, get_captcha_urls, encode_challenge, decode_challenge, \
-    create_wpm_authorization
+    create_wpm_authorization, captcha_stats, token_cache_stats
+from gui_files.leaderboard_cache import LeaderboardCache
+from gui_files.write_behind import WriteBehind
+from gui_files.multiplayer_state import QUEUE_TIMEOUT, create_state
 
-MIN_PLAYERS = 2
-MAX_PLAYERS = 4
-QUEUE_TIMEOUT = timedelta(seconds=1)
-MAX_WAIT = timedelta(seconds=5)
+# Long-polling requests return after this long even if nothing has changed.
+# Waiting for a match is capped separately, since it keeps the player queued.
+PROGRESS_POLL_TIMEOUT = timedelta(seconds=25)
+MATCH_POLL_TIMEOUT = timedelta(seconds=5)
 
 MAX_NAME_LENGTH = 30
 
+LEADERBOARD_SIZE = 20
+# Other workers' leaderboard writes become visible after at most this long.
+LEADERBOARD_MAX_AGE = timedelta(seconds=float(os.environ.get("LEADERBOARD_MAX_AGE", 10)))
+# If positive, scores are queued and written in batches this often.
+LEADERBOARD_WRITE_INTERVAL = timedelta(seconds=float(os.environ.get("LEADERBOARD_WRITE_INTERVAL", 0)))
+
+# Replaces a user's entry only if the new score is higher. In MySQL, the name
+# is assigned first, so that it compares against the old score.
+UPSERT_WPM = {
+    "mysql": """INSERT INTO leaderboard (name, user_id, wpm) VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE name = IF(VALUES(wpm) > wpm, VALUES(name), name), wpm = GREATEST(wpm, VALUES(wpm))""",
+    "sqlite": """INSERT INTO leaderboard (name, user_id, wpm) VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, wpm = excluded.wpm WHERE excluded.wpm > wpm""",
+}
+
 MAX_UNVERIFIED_WPM = 90
 CAPTCHA_ACCURACY_THRESHOLD = 60
 CAPTCHA_SLOWDOWN_FACTOR = 0.6
 
 
 def db_init():
-    setup_db("cats")
     with connect_db() as db:
         db(
             """CREATE TABLE IF NOT EXISTS leaderboard (
@@ -32,85 +49,116 @@ def db_init():
         PRIMARY KEY (`user_id`)
     );"""
         )
+        # MySQL has no CREATE INDEX IF NOT EXISTS, so check for the index first.
+        if dialect() == "sqlite":
+            db("CREATE INDEX IF NOT EXISTS `leaderboard_wpm` ON leaderboard (`wpm`)")
+        elif not db("SHOW INDEX FROM leaderboard WHERE Key_name = 'leaderboard_wpm'").fetchall():
+            db("CREATE INDEX `leaderboard_wpm` ON leaderboard (`wpm`)")
 
 
-def create_multiplayer_server():
-    State = namedtuple("State", ["queue", "game_lookup", "game_data", "progress"])
-    State = State({}, {}, {}, defaultdict(list))
-
-    @route
-    @server_only
-    def provide_id():
-        return randrange(1000000000)
-
-    @route
-    @forward_to_server
-    def request_match(id):
-        if id in State.game_lookup:
-            game_id = State.game_lookup[id]
-            return {
-                    "start": True,
-                    "text": State.game_data[game_id]["text"],
-                    "players": State.game_data[game_id]["players"],
-                }
-
-        if id not in State.queue:
-            State.queue[id] = [None, datetime.now()]
+def load_leaderboard(size):
+    with connect_db() as db:
+        return db("SELECT name, user_id, wpm FROM leaderboard ORDER BY wpm DESC LIMIT %s", [size]).fetchall()
 
-        State.queue[id][0] = datetime.now()
 
-        to_remove = []
+def count_leaderboard():
+    with connect_db() as db:
+        return db("SELECT COUNT(*) FROM leaderboard").fetchone()[0]
 
-        for player, (recent_time, join_time) in State.queue.items():
-            if datetime.now() - recent_time > QUEUE_TIMEOUT:
-                to_remove.append(player)
 
-        for player in to_remove:
-            del State.queue[player]
+def write_wpms(batch):
+    """Record each (name, user, wpm) score in BATCH in a single transaction."""
+    with connect_db() as db:
+        for name, user, wpm in batch:
+            db(UPSERT_WPM[dialect()], [name, user, wpm])
 
-        if len(State.queue) >= MAX_PLAYERS or \
-                max(datetime.now() - join_time for recent_time, join_time in State.queue.values()) >= MAX_WAIT and \
-                len(State.queue) >= MIN_PLAYERS:
-            # start game!
-            import gui
-            curr_text = gui.request_paragraph()
-            game_id = gui.request_id()
 
-            for player in State.queue:
-                State.game_lookup[player] = game_id
+def valid_lobby(lobby):
+    """Whether LOBBY can name a lobby. Lobbies are looked up by name, so only
+    strings and integers are accepted, along with None for the default lobby."""
+    return lobby is None or isinstance(lobby, (str, int))
 
-            queue = State.queue
-            players = list(queue.keys())
 
-            State.game_data[game_id] = {"text": curr_text, "players": players}
+def create_multiplayer_server():
+    State = create_state()
+    Leaderboard = LeaderboardCache(LEADERBOARD_SIZE, LEADERBOARD_MAX_AGE.total_seconds(), load_leaderboard)
+    TableSize = [0, 0]  # [number of entries, time counted]
+    if LEADERBOARD_WRITE_INTERVAL:
+        PendingScores = WriteBehind(LEADERBOARD_WRITE_INTERVAL.total_seconds(), write_wpms)
+    else:
+        PendingScores = None
+
+    def new_game():
+        import gui
+        return gui.request_paragraph(), gui.request_id()
 
-            for player in queue:
-                State.progress[player] = [(0, time.time())]
+    @route
+    @server_only
+    def provide_id():
+        return randrange(1000000000)
 
-            State.queue.clear()
+    @route
+    @forward_to_server
+    def request_match(id, lobby=None):
+        if not valid_lobby(lobby):
+            return None
+        return State.match(id, lobby, new_game)
 
-            return {"start": True, "text": curr_text, "players": players}
-        else:
-            return {"start": False, "numWaiting": len(State.queue)}
+    @route
+    @forward_to_server
+    def wait_for_match(id, lobby=None, num_waiting=None):
+        """Like request_match, but wait until the game starts or the number of
+        waiting players differs from NUM_WAITING. The player stays queued
+        while waiting."""
+        if not valid_lobby(lobby):
+            return None
+        deadline = time.time() + MATCH_POLL_TIMEOUT.total_seconds()
+        while True:
+            version = State.lobby_version(lobby)
+            result = State.match(id, lobby, new_game)
+            remaining = deadline - time.time()
+            if result["start"] or result["numWaiting"] != num_waiting or remaining <= 0:
+                return result
+            State.wait_for_lobby(lobby, version, min(remaining, QUEUE_TIMEOUT.total_seconds() / 2))
 
     @route
     @server_only
     def set_progress(id, progress):
         """Record progress message."""
-        State.progress[id].append((progress, time.time()))
+        State.set_progress(id, progress)
         return ""
 
     @route
     @forward_to_server
-    def request_progress(targets):
-        now = {t: State.progress[t][-1] for t in targets}
-        elapsed = [[now[t][0], now[t][1] - State.progress[t][0][1]] for t in targets]
-        return elapsed
+    def multiplayer_stats():
+        """Return how many players, games and progress reports are retained."""
+        return State.stats()
 
     @route
     @forward_to_server
-    def request_all_progress(targets):
-        return [State.progress[target] for target in targets]
+    def request_progress(targets, game=None):
+        return State.latest_progress(targets, game)
+
+    @route
+    @forward_to_server
+    def wait_for_progress(targets, cursor=None, game=None):
+        """Like request_progress, but wait until one of TARGETS reports progress
+        that the caller has not seen. CURSOR is the cursor returned by the
+        caller's previous call, if any."""
+        cursor = State.wait_for_progress(targets, cursor, PROGRESS_POLL_TIMEOUT.total_seconds(), game)
+        return {"progress": State.latest_progress(targets, game), "cursor": cursor}
+
+    @route
+    @forward_to_server
+    def request_all_progress(targets, game=None):
+        return State.all_progress(targets, game)
+
+    @route
+    @forward_to_server
+    def request_progress_columns(targets, game=None):
+        """Return the progress and the time of every report from each target
+        in GAME, or in their current games if it is not given."""
+        return State.progress_columns(targets, game)
 
     @route
     @forward_to_server
@@ -120,16 +168,16 @@ def create_multiplayer_server():
         if wpm > max(MAX_UNVERIFIED_WPM, authorized_limit) or len(name) > MAX_NAME_LENGTH:
             return
 
-        with connect_db() as db:
-            db("DELETE FROM leaderboard WHERE user_id = (%s)", [user])
-            db("INSERT INTO leaderboard (name, user_id, wpm) VALUES (%s, %s, %s)", [name, user, wpm])
+        if PendingScores:
+            PendingScores.record(name, user, wpm)
+        else:
+            write_wpms([(name, user, wpm)])
+        Leaderboard.record(name, user, wpm)
 
     @route
     @forward_to_server
     def check_on_leaderboard(user):
-        with connect_db() as db:
-            users = list(x[0] for x in db("SELECT user_id FROM leaderboard ORDER BY wpm DESC LIMIT 20").fetchall())
-        return bool(user in users)
+        return Leaderboard.contains(user)
 
     @route
     @forward_to_server
@@ -138,17 +186,31 @@ def create_multiplayer_server():
             return
         with connect_db() as db:
             db("UPDATE leaderboard SET name=(%s) WHERE user_id=(%s)", [new_name, user])
+        if PendingScores:
+            PendingScores.rename(user, new_name)
+        Leaderboard.rename(user, new_name)
 
     @route
     @forward_to_server
-    def check_leaderboard_eligibility(wpm, user, token):
+    def leaderboard_rank(user):
+        """Return USER's position on the whole leaderboard, counting from 1,
+        and the percentage of entries with at most their wpm. The total number
+        of entries is recounted at most once per LEADERBOARD_MAX_AGE."""
+        if time.time() - TableSize[1] > LEADERBOARD_MAX_AGE.total_seconds():
+            TableSize[:] = count_leaderboard(), time.time()
         with connect_db() as db:
-            vals = db("SELECT wpm FROM leaderboard ORDER BY wpm DESC LIMIT 20").fetchall()
-            threshold = vals[-1][0] if len(vals) >= 20 else 0
-            prev_best = db("SELECT wpm FROM leaderboard WHERE user_id=(%s)", [user]).fetchone()
-            if prev_best:
-                threshold = max(threshold, prev_best[0])
+            best = db("SELECT wpm FROM leaderboard WHERE user_id=(%s)", [user]).fetchone()
+            if not best:
+                return {"rank": None, "percentile": None, "total": TableSize[0]}
+            # A range count over the wpm index, which only visits faster entries.
+            faster = db("SELECT COUNT(*) FROM leaderboard WHERE wpm > (%s)", [best[0]]).fetchone()[0]
+        total = max(TableSize[0], faster + 1)
+        return {"rank": faster + 1, "percentile": 100 * (total - faster) / total, "total": total}
 
+    @route
+    @forward_to_server
+    def check_leaderboard_eligibility(wpm, user, token):
+        threshold = Leaderboard.threshold(user)
         authorized_limit = get_authorized_limit(user=user, token=token)
 
         return {
@@ -160,13 +222,38 @@ def create_multiplayer_server():
     @forward_to_server
     def request_wpm_challenge(user):
         captcha_image_urls, words = get_captcha_urls()
+        if not words:
+            return {
+                "images": [],
+                "token": None,
+                "lastWordLen": 0,
+                "message": "No captchas are ready yet."
+            }
         token = encode_challenge(user, words)
         return {
             "images": captcha_image_urls,
             "token": token,
-            "lastWordLen": len(words[-1])
+            "lastWordLen": len(words[-1]) if words else 0
         }
 
+    @route
+    @forward_to_server
+    def captcha_queue_stats():
+        """Return how many captchas are ready, and how long they took to render."""
+        return captcha_stats()
+
+    @route
+    @forward_to_server
+    def database_pool_stats():
+        """Return how many database connections are pooled and in use."""
+        return pool_stats()
+
+    @route
+    @forward_to_server
+    def token_stats():
+        """Return statistics of the cache of verified tokens."""
+        return token_cache_stats()
+
     @route
     @forward_to_server
     def claim_wpm_challenge(user, token, typed, claimed_wpm):
@@ -201,5 +288,4 @@ def create_multiplayer_server():
     @route
     @forward_to_server
     def leaderboard():
-        with connect_db() as db:
-            return list(list(x) for x in db("SELECT name, wpm FROM leaderboard ORDER BY wpm DESC LIMIT 20").fetchall())
+        return [[name, wpm] for name, _, wpm in Leaderboard.top()]
@@ -0,0 +1,514 @@
+"""Backends for the matchmaking and progress state of the multiplayer server.
+
+MemoryState keeps everything in the memory of one process. SQLiteState keeps
+it in a SQLite database in WAL mode, so that all the server processes on a host
+share the same lobbies, games and progress, and can run as separate gunicorn
+workers. Set MULTIPLAYER_STATE_DB to the path of that database to use it.
+
+Both backends provide the same methods, which the multiplayer routes call.
+"""
+import json
+import os
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Lock, Thread, local
+
+from gui_files.matchmaking import Lobby
+from gui_files.notifier import Notifier
+from gui_files.progress import ProgressLog
+
+MIN_PLAYERS = 2
+MAX_PLAYERS = 4
+QUEUE_TIMEOUT = timedelta(seconds=1)
+MAX_WAIT = timedelta(seconds=5)
+
+# Games are running until every player finishes, and expire once nobody has
+# reported progress for a while. Queued players learn that their game has
+# started by asking for a match within GAME_JOIN_WINDOW of its start; after
+# that, a player who asks for a match has left their game, and is queued for a
+# new one.
+RUNNING, FINISHED = "running", "finished"
+GAME_TIMEOUT = timedelta(minutes=30)
+FINISHED_GAME_TIMEOUT = timedelta(minutes=5)
+GAME_JOIN_WINDOW = timedelta(seconds=10)
+SWEEP_INTERVAL = timedelta(seconds=30)
+
+# How often each process checks a shared database for changes, and how long a
+# write waits for other processes to finish theirs.
+SHARED_POLL_INTERVAL = timedelta(milliseconds=100)
+SHARED_LOCK_TIMEOUT = timedelta(seconds=10)
+
+
+def create_state():
+    """Return the backend selected by the MULTIPLAYER_STATE_DB variable."""
+    path = os.environ.get("MULTIPLAYER_STATE_DB")
+    return SQLiteState(path) if path else MemoryState()
+
+
+class MemoryState:
+    """Multiplayer state kept in the memory of this process.
+
+    Progress is kept for each player in each game, so that a player who starts
+    a new game does not erase what the players of their last one still see."""
+
+    def __init__(self):
+        self.lobbies = {}
+        self.game_lookup = {}
+        self.game_data = {}
+        self.progress = defaultdict(ProgressLog)  # keyed by (game_id, player)
+        self.expired_games = 0
+        self.last_sweep = 0
+        self.lobby_events, self.progress_events = Notifier(), Notifier()
+        self.lock = Lock()
+
+    def sweep(self):
+        """Remove expired games and empty lobbies, along with the progress
+        reported in expired games. Runs at most once per SWEEP_INTERVAL, so
+        that its cost is spread across many requests."""
+        now = time.time()
+        if now - self.last_sweep < SWEEP_INTERVAL.total_seconds():
+            return
+        self.last_sweep = now
+
+        for lobby in list(self.lobbies):
+            self.lobbies[lobby].expire(datetime.now())
+            if not self.lobbies[lobby]:
+                del self.lobbies[lobby]
+                self.lobby_events.forget(lobby)
+
+        for game_id, game in list(self.game_data.items()):
+            timeout = FINISHED_GAME_TIMEOUT if game["status"] == FINISHED else GAME_TIMEOUT
+            if now - game["updated"] > timeout.total_seconds():
+                del self.game_data[game_id]
+                self.expired_games += 1
+                for player in game["players"]:
+                    if player in self.game_lookup and self.game_lookup[player] == game_id:
+                        del self.game_lookup[player]
+
+        for key in list(self.progress):
+            if key[0] not in self.game_data:
+                del self.progress[key]
+                self.progress_events.forget(key)
+
+    def key(self, player, game_id=None):
+        """The key of the progress of PLAYER in GAME_ID, which defaults to the
+        game they are playing now."""
+        return (self.game_lookup.get(player) if game_id is None else game_id), player
+
+    def finished(self, game_id, player):
+        """Whether PLAYER has typed the whole paragraph of GAME_ID."""
+        progress = self.progress.get((game_id, player))
+        return bool(progress) and progress.last()[0] >= 1
+
+    def match(self, id, lobby, new_game):
+        """Queue player ID in LOBBY, starting a game if enough players are
+        waiting. NEW_GAME returns the text and id of a new game."""
+        with self.lock:
+            self.sweep()
+
+            if id in self.game_lookup:
+                game_id = self.game_lookup[id]
+                game = self.game_data[game_id]
+                if game["status"] == RUNNING and not self.finished(game_id, id) \
+                        and time.time() - game["started"] < GAME_JOIN_WINDOW.total_seconds():
+                    return {"start": True, "text": game["text"], "players": game["players"], "game": game_id}
+                # This player is done with or has left their last game, so find them a new one.
+                del self.game_lookup[id]
+
+            if lobby not in self.lobbies:
+                self.lobbies[lobby] = Lobby(MIN_PLAYERS, MAX_PLAYERS, QUEUE_TIMEOUT, MAX_WAIT)
+            queue = self.lobbies[lobby]
+
+            num_waiting = len(queue)
+            players = queue.poll(id, datetime.now())
+
+            if players:
+                # start game!
+                curr_text, game_id = new_game()
+                now = time.time()
+
+                for player in players:
+                    self.game_lookup[player] = game_id
+
+                self.game_data[game_id] = {"text": curr_text, "players": players, "status": RUNNING,
+                                           "started": now, "updated": now}
+
+                for player in players:
+                    self.progress[game_id, player].append(0, now)
+                    self.progress_events.notify((game_id, player))
+
+                del self.lobbies[lobby]
+                self.lobby_events.notify(lobby)
+                self.lobby_events.forget(lobby)
+
+                return {"start": True, "text": curr_text, "players": players, "game": game_id}
+            else:
+                if len(queue) != num_waiting:
+                    self.lobby_events.notify(lobby)
+                return {"start": False, "numWaiting": len(queue)}
+
+    def lobby_version(self, lobby):
+        """A number that changes whenever the players waiting in LOBBY do."""
+        return self.lobby_events.version(lobby)
+
+    def wait_for_lobby(self, lobby, version, timeout):
+        """Wait up to TIMEOUT seconds for the version of LOBBY to differ from
+        VERSION."""
+        self.lobby_events.wait([lobby], [version], timeout)
+
+    def set_progress(self, id, progress):
+        """Record that player ID has reached PROGRESS in their current game."""
+        with self.lock:
+            game_id = self.game_lookup.get(id)
+            game = self.game_data.get(game_id)
+            if not game:
+                return
+            self.progress[game_id, id].append(progress, time.time())
+            game["updated"] = time.time()
+            if game["status"] == RUNNING and all(self.finished(game_id, player) for player in game["players"]):
+                game["status"] = FINISHED
+            self.sweep()
+        self.progress_events.notify((game_id, id))
+
+    def wait_for_progress(self, targets, cursor, timeout, game_id=None):
+        """Wait up to TIMEOUT seconds until one of TARGETS reports progress
+        after CURSOR, and return a new cursor. Progress is read from GAME_ID,
+        or from each target's current game if it is None."""
+        return self.progress_events.wait([self.key(t, game_id) for t in targets], cursor, timeout)
+
+    def latest_progress(self, targets, game_id=None):
+        """The latest progress of each of TARGETS, and the time since they
+        started."""
+        logs = [self.progress[self.key(t, game_id)] for t in targets]
+        return [[log.last()[0], log.last()[1] - log.first()[1]] for log in logs]
+
+    def all_progress(self, targets, game_id=None):
+        """All (progress, time) reports from each of TARGETS."""
+        return [self.progress[self.key(t, game_id)].samples() for t in targets]
+
+    def progress_columns(self, targets, game_id=None):
+        """The progress and the time of all reports from each of TARGETS."""
+        return [self.progress[self.key(t, game_id)].columns() for t in targets]
+
+    def stats(self):
+        """How many players, games and progress reports are retained, and
+        how many games have expired."""
+        statuses = Counter(game["status"] for game in self.game_data.values())
+        return {
+            "lobbies": len(self.lobbies),
+            "queuedPlayers": sum(len(lobby) for lobby in self.lobbies.values()),
+            "runningGames": statuses[RUNNING],
+            "finishedGames": statuses[FINISHED],
+            "expiredGames": self.expired_games,
+            "players": len(self.game_lookup),
+            "progressPoints": sum(len(progress) for progress in self.progress.values()),
+        }
+
+
+class SQLiteState:
+    """Multiplayer state kept in a SQLite database at PATH, shared by all the
+    processes that open it.
+
+    Matching and recording progress each run in a single write transaction, so
+    a game is formed by exactly one process. Player ids, game ids and lobby
+    names are stored as JSON, so that they come back with the same types.
+
+    Changes to lobbies and progress are numbered in the order they are made.
+    One thread in each process reads new changes every SHARED_POLL_INTERVAL
+    and wakes the requests in that process that wait for them, so waiting
+    requests do not query the database themselves. The numbers of the latest
+    changes serve as versions and cursors, so they mean the same thing in every
+    process.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS queue (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            lobby TEXT NOT NULL,
+            player TEXT NOT NULL,
+            recent REAL NOT NULL,
+            joined REAL NOT NULL,
+            UNIQUE (lobby, player)
+        )""",
+        "CREATE INDEX IF NOT EXISTS queue_recent ON queue (lobby, recent)",
+        "CREATE INDEX IF NOT EXISTS queue_joined ON queue (lobby, joined)",
+        """CREATE TABLE IF NOT EXISTS games (
+            game_id TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            players TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started REAL NOT NULL,
+            updated REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS game_players (
+            game_id TEXT NOT NULL,
+            player TEXT NOT NULL,
+            PRIMARY KEY (game_id, player)
+        )""",
+        "CREATE INDEX IF NOT EXISTS game_players_player ON game_players (player)",
+        "CREATE TABLE IF NOT EXISTS game_lookup (player TEXT PRIMARY KEY, game_id TEXT NOT NULL)",
+        """CREATE TABLE IF NOT EXISTS progress (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            game_id TEXT NOT NULL,
+            player TEXT NOT NULL,
+            progress REAL NOT NULL,
+            time REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS progress_player ON progress (game_id, player, seq)",
+        """CREATE TABLE IF NOT EXISTS lobby_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            lobby TEXT NOT NULL,
+            time REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS sweeps (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            time REAL NOT NULL,
+            expired_games INTEGER NOT NULL
+        )""",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = local()
+        self.lobby_events, self.progress_events = Notifier(), Notifier()
+        self.last_lobby_change, self.last_report = 0, 0  # the latest changes read
+        self.poller = None
+        self.lock = Lock()
+        with self.transaction() as db:
+            for statement in self.SCHEMA:
+                db.execute(statement)
+
+    def connect(self):
+        """This thread's connection to the database."""
+        if not hasattr(self.connections, "db"):
+            # Waiting for locks is left to transaction, so keep SQLite's own
+            # waits, which block every green thread in the process, short.
+            db = sqlite3.connect(self.path, timeout=0.05, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.connections.db = db
+        return self.connections.db
+
+    @contextmanager
+    def transaction(self):
+        """A write transaction, which holds the database lock from the start so
+        that its reads cannot be made stale by other processes. While another
+        process holds the lock, this one sleeps between attempts to take it."""
+        db = self.connect()
+        deadline = time.time() + SHARED_LOCK_TIMEOUT.total_seconds()
+        while True:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or time.time() > deadline:
+                    raise
+                time.sleep(0.01)
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def bump(self, db, key):
+        """Record a change to the lobby stored as KEY within the transaction DB."""
+        db.execute("INSERT INTO lobby_changes (lobby, time) VALUES (?, ?)", [key, time.time()])
+
+    def start_poller(self):
+        """Start the thread that reads changes for this process, if it is not
+        running. The changes made so far are read first."""
+        with self.lock:
+            if self.poller is None:
+                self.poll()
+                self.poller = Thread(target=self.run_poller, daemon=True)
+                self.poller.start()
+
+    def run_poller(self):
+        last_retain = time.time()
+        while True:
+            time.sleep(SHARED_POLL_INTERVAL.total_seconds())
+            try:
+                self.poll()
+                if time.time() - last_retain > SWEEP_INTERVAL.total_seconds():
+                    self.retain()
+                    last_retain = time.time()
+            except sqlite3.Error as e:
+                print("Failed to read multiplayer changes: {}".format(e))
+
+    def poll(self):
+        """Wake up the requests waiting for lobbies or progress that changed
+        since the last poll."""
+        db = self.connect()
+        for lobby, seq in db.execute("SELECT lobby, MAX(seq) FROM lobby_changes WHERE seq > ? GROUP BY lobby",
+                                     [self.last_lobby_change]).fetchall():
+            self.lobby_events.update(lobby, seq)
+            self.last_lobby_change = max(self.last_lobby_change, seq)
+        for game_key, player, seq in db.execute(
+                "SELECT game_id, player, MAX(seq) FROM progress WHERE seq > ? GROUP BY game_id, player",
+                [self.last_report]).fetchall():
+            self.progress_events.update((game_key, player), seq)
+            self.last_report = max(self.last_report, seq)
+
+    def retain(self):
+        """Stop tracking the lobbies and games that the sweep has removed."""
+        db = self.connect()
+        lobbies = {lobby for lobby, in db.execute("SELECT DISTINCT lobby FROM lobby_changes")}
+        games = {game_key for game_key, in db.execute("SELECT game_id FROM games")}
+        self.lobby_events.retain(lambda lobby: lobby in lobbies)
+        self.progress_events.retain(lambda key: key[0] in games)
+
+    def sweep(self, db):
+        """Like MemoryState.sweep, within the transaction DB."""
+        now = time.time()
+        last_sweep = db.execute("SELECT time FROM sweeps").fetchone()
+        if last_sweep and now - last_sweep[0] < SWEEP_INTERVAL.total_seconds():
+            return
+        db.execute("INSERT INTO sweeps VALUES (0, ?, 0) ON CONFLICT (id) DO UPDATE SET time = excluded.time", [now])
+
+        db.execute("DELETE FROM queue WHERE ? - recent > ?", [now, QUEUE_TIMEOUT.total_seconds()])
+        expired = [game_id for game_id, in db.execute(
+            "SELECT game_id FROM games WHERE ? - updated > CASE status WHEN ? THEN ? ELSE ? END",
+            [now, FINISHED, FINISHED_GAME_TIMEOUT.total_seconds(), GAME_TIMEOUT.total_seconds()])]
+        for game_id in expired:
+            db.execute("DELETE FROM games WHERE game_id = ?", [game_id])
+            db.execute("DELETE FROM game_players WHERE game_id = ?", [game_id])
+            db.execute("DELETE FROM game_lookup WHERE game_id = ?", [game_id])
+            db.execute("DELETE FROM progress WHERE game_id = ?", [game_id])
+        db.execute("UPDATE sweeps SET expired_games = expired_games + ?", [len(expired)])
+        db.execute("DELETE FROM lobby_changes WHERE ? - time > ?", [now, SWEEP_INTERVAL.total_seconds()])
+
+    def finished(self, db, game_key, player):
+        """Whether the player stored as PLAYER has typed the whole paragraph of
+        the game stored as GAME_KEY."""
+        row = db.execute("SELECT progress FROM progress WHERE game_id = ? AND player = ? ORDER BY seq DESC LIMIT 1",
+                         [game_key, player]).fetchone()
+        return bool(row) and row[0] >= 1
+
+    def keys(self, db, targets, game_id):
+        """The stored (game, player) keys of the progress of TARGETS in GAME_ID,
+        which defaults to the game each of them is playing now."""
+        players = [json.dumps(t) for t in targets]
+        if game_id is not None:
+            return [(json.dumps(game_id), player) for player in players]
+        lookup = {player: game_key for player, game_key in db.execute(
+            "SELECT player, game_id FROM game_lookup WHERE player IN ({})".format(", ".join("?" * len(players))),
+            players)}
+        return [(lookup.get(player), player) for player in players]
+
+    def match(self, id, lobby, new_game):
+        """Like MemoryState.match."""
+        player, lobby_key = json.dumps(id), json.dumps(lobby)
+        with self.transaction() as db:
+            self.sweep(db)
+
+            now = time.time()
+            row = db.execute("SELECT g.game_id, g.text, g.players, g.status, g.started FROM game_lookup l "
+                             "JOIN games g ON g.game_id = l.game_id WHERE l.player = ?", [player]).fetchone()
+            if row:
+                game_key, text, players, status, started = row
+                if status == RUNNING and not self.finished(db, game_key, player) \
+                        and now - started < GAME_JOIN_WINDOW.total_seconds():
+                    return {"start": True, "text": text, "players": json.loads(players), "game": json.loads(game_key)}
+                # This player is done with or has left their last game, so find them a new one.
+                db.execute("DELETE FROM game_lookup WHERE player = ?", [player])
+
+            num_waiting, = db.execute("SELECT COUNT(*) FROM queue WHERE lobby = ?", [lobby_key]).fetchone()
+            db.execute("INSERT INTO queue (lobby, player, recent, joined) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT (lobby, player) DO UPDATE SET recent = excluded.recent",
+                       [lobby_key, player, now, now])
+            db.execute("DELETE FROM queue WHERE lobby = ? AND ? - recent > ?",
+                       [lobby_key, now, QUEUE_TIMEOUT.total_seconds()])
+            waiting, earliest_join = db.execute("SELECT COUNT(*), MIN(joined) FROM queue WHERE lobby = ?",
+                                                [lobby_key]).fetchone()
+
+            if waiting >= MAX_PLAYERS or \
+                    now - earliest_join >= MAX_WAIT.total_seconds() and waiting >= MIN_PLAYERS:
+                # start game!
+                keys = [key for key, in db.execute("SELECT player FROM queue WHERE lobby = ? ORDER BY seq",
+                                                   [lobby_key])]
+                players = [json.loads(key) for key in keys]
+                curr_text, game_id = new_game()
+                game_key = json.dumps(game_id)
+
+                db.execute("INSERT INTO games VALUES (?, ?, ?, ?, ?, ?)",
+                           [game_key, curr_text, json.dumps(players), RUNNING, now, now])
+                for key in keys:
+                    db.execute("INSERT INTO game_players VALUES (?, ?)", [game_key, key])
+                    db.execute("INSERT OR REPLACE INTO game_lookup VALUES (?, ?)", [key, game_key])
+                    db.execute("INSERT INTO progress (game_id, player, progress, time) VALUES (?, ?, 0, ?)",
+                               [game_key, key, now])
+
+                db.execute("DELETE FROM queue WHERE lobby = ?", [lobby_key])
+                self.bump(db, lobby_key)
+                return {"start": True, "text": curr_text, "players": players, "game": game_id}
+            else:
+                if waiting != num_waiting:
+                    self.bump(db, lobby_key)
+                return {"start": False, "numWaiting": waiting}
+
+    def lobby_version(self, lobby):
+        self.start_poller()
+        return self.lobby_events.version(json.dumps(lobby))
+
+    def wait_for_lobby(self, lobby, version, timeout):
+        self.lobby_events.wait([json.dumps(lobby)], [version], timeout)
+
+    def set_progress(self, id, progress):
+        player = json.dumps(id)
+        with self.transaction() as db:
+            now = time.time()
+            row = db.execute("SELECT g.game_id, g.status FROM game_lookup l JOIN games g ON g.game_id = l.game_id "
+                             "WHERE l.player = ?", [player]).fetchone()
+            if row:
+                game_key, status = row
+                db.execute("INSERT INTO progress (game_id, player, progress, time) VALUES (?, ?, ?, ?)",
+                           [game_key, player, progress, now])
+                db.execute("UPDATE games SET updated = ? WHERE game_id = ?", [now, game_key])
+                players = [key for key, in db.execute("SELECT player FROM game_players WHERE game_id = ?",
+                                                      [game_key])]
+                if status == RUNNING and all(self.finished(db, game_key, key) for key in players):
+                    db.execute("UPDATE games SET status = ? WHERE game_id = ?", [FINISHED, game_key])
+            self.sweep(db)
+
+    def wait_for_progress(self, targets, cursor, timeout, game_id=None):
+        self.start_poller()
+        return self.progress_events.wait(self.keys(self.connect(), targets, game_id), cursor, timeout)
+
+    def reports(self, key, order="ASC", limit=-1):
+        """The (progress, time) reports stored under the (game, player) KEY,
+        in ORDER."""
+        return self.connect().execute(
+            "SELECT progress, time FROM progress WHERE game_id = ? AND player = ? ORDER BY seq {} LIMIT ?".format(
+                order), [*key, limit]).fetchall()
+
+    def latest_progress(self, targets, game_id=None):
+        elapsed = []
+        for key in self.keys(self.connect(), targets, game_id):
+            (first_progress, first_time), = self.reports(key, limit=1)
+            (progress, now), = self.reports(key, "DESC", 1)
+            elapsed.append([progress, now - first_time])
+        return elapsed
+
+    def all_progress(self, targets, game_id=None):
+        return [self.reports(key) for key in self.keys(self.connect(), targets, game_id)]
+
+    def progress_columns(self, targets, game_id=None):
+        return [[list(column) for column in zip(*self.reports(key))] or [[], []]
+                for key in self.keys(self.connect(), targets, game_id)]
+
+    def stats(self):
+        db = self.connect()
+        statuses = dict(db.execute("SELECT status, COUNT(*) FROM games GROUP BY status").fetchall())
+        return {
+            "lobbies": db.execute("SELECT COUNT(DISTINCT lobby) FROM queue").fetchone()[0],
+            "queuedPlayers": db.execute("SELECT COUNT(*) FROM queue").fetchone()[0],
+            "runningGames": statuses.get(RUNNING, 0),
+            "finishedGames": statuses.get(FINISHED, 0),
+            "expiredGames": (db.execute("SELECT expired_games FROM sweeps").fetchone() or [0])[0],
+            "players": db.execute("SELECT COUNT(*) FROM game_lookup").fetchone()[0],
+            "progressPoints": db.execute("SELECT COUNT(*) FROM progress").fetchone()[0],
+        }
@@ -0,0 +1,89 @@
+"""Wakes up requests that are waiting for something to change."""
+from collections import defaultdict
+from threading import Event, Lock
+
+
+class Notifier:
+    """Tracks a version number for each key, and lets requests wait until the
+    version of one of a set of keys changes.
+
+    Each waiter blocks on its own Event, which is only set when one of its keys
+    changes, so idle waiters cost no work. Under gunicorn's gevent workers,
+    waiters are greenlets rather than threads, so thousands of them can wait
+    in one worker.
+
+    >>> notifier = Notifier()
+    >>> notifier.wait(['a', 'b'], None, 10)
+    [0, 0]
+    >>> notifier.notify('b')
+    >>> notifier.wait(['a', 'b'], [0, 0], 10)
+    [0, 1]
+    >>> notifier.wait(['a', 'b'], [0, 1], 0.01)
+    [0, 1]
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.versions = {}
+        self.waiters = defaultdict(set)
+
+    def version(self, key):
+        """The number of times KEY has changed."""
+        return self.versions.get(key, 0)
+
+    def notify(self, key):
+        """Record that KEY has changed, and wake up everyone waiting for it."""
+        with self.lock:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            waiters = self.waiters.pop(key, ())
+        for event in waiters:
+            event.set()
+
+    def update(self, key, version):
+        """Record that KEY has reached VERSION, which is kept elsewhere, and
+        wake up everyone waiting for it. Older versions are ignored.
+
+        >>> notifier = Notifier()
+        >>> notifier.update('a', 5)
+        >>> notifier.update('a', 3)
+        >>> notifier.version('a')
+        5
+        """
+        with self.lock:
+            if version <= self.versions.get(key, 0):
+                return
+            self.versions[key] = version
+            waiters = self.waiters.pop(key, ())
+        for event in waiters:
+            event.set()
+
+    def wait(self, keys, seen, timeout):
+        """Wait up to TIMEOUT seconds until the versions of KEYS differ from
+        SEEN, and return their versions. Returns immediately if they already
+        differ, which is always the case if SEEN is None."""
+        event = Event()
+        with self.lock:
+            versions = [self.versions.get(key, 0) for key in keys]
+            if versions != seen:
+                return versions
+            for key in keys:
+                self.waiters[key].add(event)
+        event.wait(timeout)
+        with self.lock:
+            for key in keys:
+                if key in self.waiters:
+                    self.waiters[key].discard(event)
+                    if not self.waiters[key]:
+                        del self.waiters[key]
+            return [self.versions.get(key, 0) for key in keys]
+
+    def forget(self, key):
+        """Stop tracking KEY, which will no longer change."""
+        with self.lock:
+            self.versions.pop(key, None)
+
+    def retain(self, keep):
+        """Stop tracking each key for which KEEP returns false."""
+        with self.lock:
+            for key in [key for key in self.versions if not keep(key)]:
+                del self.versions[key]
@@ -0,0 +1,59 @@
+"""The corpus of paragraphs for typing tests, kept in memory."""
+import os
+import random
+from collections import defaultdict
+
+import cats
+
+
+class Corpus:
+    """The lines of the file at PATH, reloaded whenever the file changes,
+    along with an index from each word to the paragraphs that contain it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.paragraphs = ()
+        self.index = {}
+
+    def load(self):
+        """Return the paragraphs as a tuple and the index of their words,
+        rereading the file if it has changed since it was last read."""
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            paragraphs = tuple(cats.lines_from_file(self.path))
+            index = defaultdict(list)
+            for i, paragraph in enumerate(paragraphs):
+                for word in set(cats.split(cats.lower(cats.remove_punctuation(paragraph)))):
+                    index[word].append(i)
+            self.paragraphs, self.index = paragraphs, {w: tuple(ids) for w, ids in index.items()}
+            self.version = version
+        return self.paragraphs, self.index
+
+    def about(self, topics):
+        """Return the paragraphs that contain one of the words in TOPICS, in
+        order, as cats.about(TOPICS) would select them."""
+        assert all([cats.lower(x) == x for x in topics]), 'topics should be lowercase.'
+        paragraphs, index = self.load()
+        ids = set()
+        for topic in topics:
+            ids.update(index.get(topic, ()))
+        return [paragraphs[i] for i in sorted(ids)]
+
+    def choose(self, topics, k):
+        """Return the Kth paragraph about TOPICS, or the empty string if there
+        are not that many, like cats.choose(paragraphs, cats.about(TOPICS), K).
+        """
+        matches = self.about(topics)
+        return matches[k] if k < len(matches) else ''
+
+    def choose_random(self, topics=None):
+        """Return a random paragraph about TOPICS, or any paragraph if there
+        are no TOPICS, like choosing the first match from a shuffled copy of
+        the paragraphs. Returns the empty string if none match."""
+        if not topics:
+            paragraphs, _ = self.load()
+        else:
+            paragraphs = self.about(topics)
+        return random.choice(paragraphs) if paragraphs else ''
@@ -0,0 +1,56 @@
+"""Compact storage for the progress reports of multiplayer players."""
+from array import array
+
+MAX_PROGRESS_REPORTS = 2000
+
+
+class ProgressLog:
+    """The (progress, time) reports of one player, stored as two columns of
+    floats rather than as a list of tuples.
+
+    The first report is always kept, since times are measured from it. Beyond
+    CAPACITY reports, the oldest of the others are discarded.
+
+    >>> log = ProgressLog(capacity=3)
+    >>> for i in range(5):
+    ...     log.append(i / 4, 10 + i)
+    >>> log.first(), log.last()
+    ((0.0, 10.0), (1.0, 14.0))
+    >>> log.samples()
+    [(0.0, 10.0), (0.75, 13.0), (1.0, 14.0)]
+    """
+
+    def __init__(self, capacity=MAX_PROGRESS_REPORTS):
+        assert capacity >= 2, 'capacity must be at least 2'
+        self.capacity = capacity
+        self.progress = array("d")
+        self.times = array("d")
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, progress, time):
+        """Record that the player reached PROGRESS at TIME."""
+        self.progress.append(progress)
+        self.times.append(time)
+        if len(self.times) > self.capacity:
+            # Discard in chunks, so that appending takes constant amortized time.
+            excess = len(self.times) - self.capacity + self.capacity // 2
+            del self.progress[1:1 + excess]
+            del self.times[1:1 + excess]
+
+    def first(self):
+        """The first (progress, time) report."""
+        return self.progress[0], self.times[0]
+
+    def last(self):
+        """The most recent (progress, time) report."""
+        return self.progress[-1], self.times[-1]
+
+    def samples(self):
+        """A list of all retained (progress, time) reports."""
+        return list(zip(self.progress, self.times))
+
+    def columns(self):
+        """Lists of the progress and the time of all retained reports."""
+        return self.progress.tolist(), self.times.tolist()
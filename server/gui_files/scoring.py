@@ -0,0 +1,65 @@
+"""Scores for a typing test that are updated as words are typed, rather than
+recomputed from the whole text on every request."""
+
+
+class ScoringSession:
+    """The words typed so far in response to PROMPT, along with running
+    totals from which wpm, accuracy and progress are computed in constant time.
+
+    >>> session = ScoringSession('Cute Dog. I say!')
+    >>> session.update(0, ['Cute', 'dog.'])
+    True
+    >>> session.accuracy(), session.progress()
+    (50.0, 0.25)
+    >>> session.update(1, ['Dog.', 'I'])
+    True
+    >>> session.accuracy(), session.progress(), session.wpm(60)
+    (100.0, 0.75, 2.2)
+    >>> session.update(4, ['say!'])
+    False
+    """
+
+    def __init__(self, prompt):
+        self.prompt = prompt.split()
+        self.typed = []
+        self.correct = [0]  # correct[i] is how many of the first i typed words match the prompt
+        self.lengths = [0]  # lengths[i] is the total length of the first i typed words
+        self.first_mistake = None  # the index of the first word that does not match, if any
+
+    def update(self, keep, added):
+        """Keep the first KEEP typed words, and then add the words in ADDED.
+        Returns False, changing nothing, if fewer than KEEP words were typed."""
+        if keep > len(self.typed):
+            return False
+        del self.typed[keep:], self.correct[keep + 1:], self.lengths[keep + 1:]
+        if self.first_mistake is not None and self.first_mistake >= keep:
+            self.first_mistake = None
+        for word in added:
+            i = len(self.typed)
+            matches = i < len(self.prompt) and word == self.prompt[i]
+            if not matches and self.first_mistake is None:
+                self.first_mistake = i
+            self.typed.append(word)
+            self.correct.append(self.correct[-1] + matches)
+            self.lengths.append(self.lengths[-1] + len(word))
+        return True
+
+    def wpm(self, elapsed):
+        """Words per minute, counting five characters of the typed words
+        joined by spaces as a word, as cats.wpm does."""
+        assert elapsed > 0, 'Elapsed time must be positive'
+        characters = self.lengths[-1] + max(0, len(self.typed) - 1)
+        return characters / 5 * 60 / elapsed
+
+    def accuracy(self):
+        """The percentage of typed words that match the prompt, as
+        cats.accuracy computes it."""
+        if not self.typed:
+            return 0.0
+        return self.correct[-1] / len(self.typed) * 100
+
+    def progress(self):
+        """The fraction of the prompt typed correctly before the first
+        mistake, as cats.report_progress computes it."""
+        correct = len(self.typed) if self.first_mistake is None else self.first_mistake
+        return correct / len(self.prompt)
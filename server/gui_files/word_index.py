@@ -0,0 +1,106 @@
+"""Index of dictionary words by letter set, for finding autocorrect candidates."""
+from array import array
+from bisect import bisect_left
+from itertools import combinations
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def popcount(mask):
+    """The number of bits set in MASK."""
+    return bin(mask).count("1")
+
+
+class LetterIndex:
+    """Stores a bitmask of the letters in each of WORDS in compact arrays.
+
+    A word w is similar to a set of letters L within N when at most N letters of
+    L are missing from w and at most N letters of w are missing from L, as in
+    gui.similar. With NumPy, we find these words by counting the bits in the
+    intersection of each mask with the mask of L. Otherwise, we enumerate the
+    masks that satisfy this and look each of them up in the sorted masks.
+    """
+
+    ARRAYS = ["masks", "sizes", "order", "keys", "starts"]
+
+    def __init__(self, words, alphabet, masks, sizes, order, keys, starts):
+        self.words = words
+        self.alphabet = alphabet
+        self.bits = {c: 1 << i for i, c in enumerate(alphabet)}
+        self.masks, self.sizes = masks, sizes
+        self.order, self.keys, self.starts = order, keys, starts
+
+    @classmethod
+    def build(cls, words):
+        """Return a LetterIndex of WORDS."""
+        alphabet = "".join(sorted(set().union(*words)))
+        assert len(alphabet) <= 64, "too many distinct letters for a bitmask"
+        bits = {c: 1 << i for i, c in enumerate(alphabet)}
+        masks = array("I" if len(alphabet) <= 32 else "Q", (sum(bits[c] for c in set(w)) for w in words))
+        sizes = array("b", map(popcount, masks))
+
+        # Word indices sorted by mask, and where each distinct mask starts.
+        order = array("I", sorted(range(len(words)), key=masks.__getitem__))
+        keys, starts = array(masks.typecode), array("I")
+        for position, i in enumerate(order):
+            if not keys or keys[-1] != masks[i]:
+                keys.append(masks[i])
+                starts.append(position)
+        starts.append(len(order))
+        return cls(words, alphabet, masks, sizes, order, keys, starts)
+
+    def mask(self, letters):
+        """Return the bitmask of LETTERS, ignoring letters outside the alphabet."""
+        m = 0
+        for c in letters:
+            m |= self.bits.get(c, 0)
+        return m
+
+    def similar(self, letters, n):
+        """Return the words w for which similar(set(w), LETTERS, N) holds, in
+        the order they appear in the dictionary.
+
+        >>> index = LetterIndex.build(['cat', 'act', 'dog', 'cart', 'at'])
+        >>> index.similar(set('cat'), 1)
+        ['cat', 'act', 'cart', 'at']
+        """
+        letters = set(letters)
+        query = self.mask(letters)
+        unknown = len(letters) - popcount(query)
+        if unknown > n:
+            return []
+        if np is not None and hasattr(np, "bitwise_count"):
+            matches = self.scan(query, len(letters), n)
+        else:
+            matches = self.enumerate(query, unknown, n)
+        return [self.words[i] for i in matches]
+
+    def scan(self, query, size, n):
+        """Return the indices of all words similar to QUERY, a mask of SIZE
+        letters, by counting the letters they share with it."""
+        masks = np.frombuffer(self.masks, dtype="u{}".format(self.masks.itemsize))
+        sizes = np.frombuffer(self.sizes, dtype=np.int8)
+        shared = np.bitwise_count(masks & masks.dtype.type(query))
+        return np.flatnonzero((shared >= sizes - n) & (shared >= size - n))
+
+    def enumerate(self, query, unknown, n):
+        """Return the indices of all words similar to QUERY, a mask that omits
+        UNKNOWN letters, by looking up every mask that could be similar."""
+        known = [b for b in self.bits.values() if b & query]
+        missing = [b for b in self.bits.values() if not b & query]
+        additions = [sum(added) for k in range(n + 1) for added in combinations(missing, k)]
+
+        matches = []
+        for k in range(n - unknown + 1):
+            for removed in combinations(known, k):
+                kept = query - sum(removed)
+                for added in additions:
+                    key = kept | added
+                    j = bisect_left(self.keys, key)
+                    if j < len(self.keys) and self.keys[j] == key:
+                        matches.extend(self.order[self.starts[j]:self.starts[j + 1]])
+        matches.sort()
+        return matches
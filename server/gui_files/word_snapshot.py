@@ -0,0 +1,129 @@
+"""A prebuilt binary snapshot of the autocorrect dictionary and its index.
+
+The snapshot holds the words of the dictionary file and the arrays of its
+LetterIndex. It is memory-mapped when loaded, so the index arrays are shared
+between all the server processes on a host, and it is rebuilt whenever the
+contents of the dictionary file change.
+
+Run `python3 -m gui_files.word_snapshot` from the server directory to build it
+ahead of time.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from gui_files.word_index import LetterIndex
+
+WORDS_PATH = "data/words.txt"
+SNAPSHOT_PATH = "data/words.snapshot"
+
+MAGIC = b"CATSDICT"
+VERSION = 1
+HEADER = struct.Struct("<8sI")  # magic, then the length of the JSON metadata
+ALIGNMENT = 8
+
+
+def source_digest(words_path):
+    """A digest of the contents of WORDS_PATH."""
+    with open(words_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def build_snapshot(words_path=WORDS_PATH, snapshot_path=SNAPSHOT_PATH):
+    """Write a snapshot of the dictionary at WORDS_PATH to SNAPSHOT_PATH, and
+    return its words and index."""
+    with open(words_path, "r") as f:
+        words = [line.strip() for line in f.readlines()]
+    index = LetterIndex.build(words)
+
+    sections = [("words", "B", "\n".join(words).encode("utf-8"))]
+    sections += [(name, getattr(index, name).typecode, getattr(index, name).tobytes())
+                 for name in LetterIndex.ARRAYS]
+    metadata = {
+        "version": VERSION,
+        "source": source_digest(words_path),
+        "count": len(words),
+        "alphabet": index.alphabet,
+        "sections": {},
+    }
+    offset = 0
+    for name, typecode, data in sections:
+        metadata["sections"][name] = [offset, len(data), typecode]
+        offset += len(data) + -len(data) % ALIGNMENT
+    encoded = json.dumps(metadata).encode("utf-8")
+    encoded += b" " * (-(HEADER.size + len(encoded)) % ALIGNMENT)
+
+    # Write to a temporary file first, so that other processes never see a
+    # partially written snapshot.
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(encoded)))
+            f.write(encoded)
+            for name, typecode, data in sections:
+                f.write(data)
+                f.write(b"\0" * (-len(data) % ALIGNMENT))
+        os.replace(temp_path, snapshot_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return words, index
+
+
+def read_snapshot(snapshot_path, digest):
+    """Return the words and index in SNAPSHOT_PATH, or None if it does not
+    exist or was not built from a dictionary with DIGEST."""
+    try:
+        with open(snapshot_path, "rb") as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    if len(view) < HEADER.size:
+        return None
+    magic, length = HEADER.unpack(view[:HEADER.size])
+    if magic != MAGIC:
+        return None
+    start = HEADER.size + length
+
+    def section(name):
+        offset, size, typecode = metadata["sections"][name]
+        if start + offset + size > len(view):
+            raise ValueError("section {} is truncated".format(name))
+        return view[start + offset:start + offset + size].cast(typecode)
+
+    # A malformed header or section means the snapshot should be rebuilt.
+    try:
+        metadata = json.loads(bytes(view[HEADER.size:start]).decode("utf-8"))
+        if metadata["version"] != VERSION or metadata["source"] != digest:
+            return None
+        text = bytes(section("words")).decode("utf-8")
+        words = text.split("\n") if metadata["count"] else []
+        if len(words) != metadata["count"]:
+            return None
+        arrays = [section(name) for name in LetterIndex.ARRAYS]
+        return words, LetterIndex(words, metadata["alphabet"], *arrays)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def load_dictionary(words_path=WORDS_PATH, snapshot_path=SNAPSHOT_PATH):
+    """Return the words in WORDS_PATH and their LetterIndex, from the snapshot
+    at SNAPSHOT_PATH if it is up to date and from a new snapshot otherwise."""
+    loaded = read_snapshot(snapshot_path, source_digest(words_path))
+    if loaded is None:
+        try:
+            loaded = build_snapshot(words_path, snapshot_path)
+        except OSError:
+            with open(words_path, "r") as f:
+                words = [line.strip() for line in f.readlines()]
+            loaded = words, LetterIndex.build(words)
+    return loaded
+
+
+if __name__ == "__main__":
+    words, _ = build_snapshot()
+    print("Wrote a snapshot of {} words to {}".format(len(words), SNAPSHOT_PATH))
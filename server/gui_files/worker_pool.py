@@ -0,0 +1,56 @@
+"""An optional process pool for running CPU-bound work outside the GIL.
+
+Workers are forked from the server process, so module-level data that is
+already loaded, such as the autocorrect dictionary and its index, is shared
+with them rather than sent along with every task. Functions passed to run must
+be defined at the top level of a module.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+pool = None
+pool_size = 0
+pool_lock = Lock()
+
+
+def start_pool(num_workers):
+    """Start NUM_WORKERS worker processes, where processes can be forked.
+    Call this once the data they need has been loaded, and before the server
+    starts handling requests."""
+    global pool, pool_size
+    if pool is None and num_workers > 0 and "fork" in multiprocessing.get_all_start_methods():
+        pool, pool_size = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")), num_workers
+        # Fork the workers now, before the server starts any request threads.
+        for future in [pool.submit(int) for _ in range(num_workers)]:
+            future.result()
+
+
+def replace_pool(broken):
+    """Replace the pool BROKEN, in which a worker has died, with a new pool
+    of as many workers. The new workers are forked when the next task is
+    submitted."""
+    global pool
+    with pool_lock:
+        if pool is broken:
+            print("An autocorrect worker died, so the worker pool is being restarted")
+            pool = ProcessPoolExecutor(pool_size, mp_context=multiprocessing.get_context("fork"))
+
+
+def run(fn, args, timeout, fallback):
+    """Return FN(*ARGS), computed by a pool worker if the pool has been
+    started. Returns FALLBACK if the worker takes longer than TIMEOUT seconds
+    or dies, in which case the pool is replaced."""
+    current = pool
+    if current is None:
+        return fn(*args)
+    try:
+        future = current.submit(fn, *args)
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        return fallback
+    except BrokenProcessPool:
+        replace_pool(current)
+        return fallback
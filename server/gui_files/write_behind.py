@@ -0,0 +1,65 @@
+"""An optional queue that delays and batches leaderboard writes."""
+import atexit
+from threading import Event, Lock, Thread
+
+
+class WriteBehind:
+    """Scores waiting to be written by WRITE(batch), where BATCH is a list of
+    (name, user, wpm) entries with at most one per user.
+
+    Only the best score of each user since the last flush is kept. A
+    background thread flushes every INTERVAL seconds, and the queue is
+    flushed once more when the process exits.
+    """
+
+    def __init__(self, interval, write):
+        self.interval, self.write = interval, write
+        self.pending = {}  # user -> [name, wpm]
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def record(self, name, user, wpm):
+        """Queue a score of WPM by USER under NAME."""
+        with self.lock:
+            if user not in self.pending or wpm > self.pending[user][1]:
+                self.pending[user] = [name, wpm]
+
+    def rename(self, user, name):
+        """Make any queued score by USER use NAME."""
+        with self.lock:
+            if user in self.pending:
+                self.pending[user][0] = name
+
+    def flush(self):
+        """Write all the queued scores in one batch."""
+        with self.flush_lock:
+            with self.lock:
+                batch = [(name, user, wpm) for user, (name, wpm) in self.pending.items()]
+                self.pending = {}
+            if batch:
+                try:
+                    self.write(batch)
+                except Exception:
+                    # Keep the scores for the next flush, unless newer ones replaced them.
+                    for name, user, wpm in batch:
+                        self.record(name, user, wpm)
+                    raise
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print("Failed to write leaderboard scores, will retry: {}".format(e))
+
+    def stop(self):
+        """Stop the background thread and write what remains."""
+        self.stopped.set()
+        self.flush()
@@ -15,9 +15,16 @@ import post from "./post";
 import Prompt from "./Prompt.js";
 import ProgressBars from "./ProgressBars.js";
 import HighScorePrompt from "./HighScorePrompt.js";
+import IncrementalScorer from "./IncrementalScorer";
 import TopicPicker from "./TopicPicker";
 import { getCurrTime, randomString } from "./utils";
 
+// How long to wait before asking the server again after a request fails.
+const RETRY_DELAY = 1000;
+
+// How long to collect typed words before autocorrecting them in one request.
+const CORRECTION_DELAY = 500;
+
 export const Mode = {
     SINGLE: "single",
     MULTI: "multi",
@@ -42,6 +49,7 @@ class App extends Component {
             numPlayers: 1,
             mode: Mode.SINGLE,
             playerList: [],
+            game: null,
             progress: [],
             showLeaderboard: false,
             fastestWords: [],
@@ -50,7 +58,13 @@ class App extends Component {
             topics: [],
         };
         this.timer = null;
-        this.multiplayerTimer = null;
+        this.correctionTimer = null;
+        this.pendingCorrections = []; // [wordIndex, word] pairs waiting to be autocorrected
+        this.multiplayerLoop = null; // Replaced to stop the loop that is waiting for the server.
+        this.analyzer = new IncrementalScorer("/analyze_incremental", "/analyze");
+        this.progressReporter = new IncrementalScorer(
+            "/report_progress_incremental", "/report_progress",
+        );
 
         post("/request_id").then((id) => {
             if (id !== null) {
@@ -80,7 +94,8 @@ class App extends Component {
 
     componentWillUnmount() {
         clearInterval(this.timer);
-        clearInterval(this.multiplayerTimer);
+        clearTimeout(this.correctionTimer);
+        this.multiplayerLoop = null;
     }
 
     initialize = () => {
@@ -124,36 +139,58 @@ class App extends Component {
     };
 
     updateReadouts = async () => {
+        if (this.analyzer.busy) {
+            // Skip this tick rather than queueing requests behind a slow one.
+            return;
+        }
         const promptedText = this.state.promptedWords.join(" ");
         const typedText = this.state.typedWords.join(" ");
-        const { wpm, accuracy } = await post("/analyze", {
-            promptedText,
-            typedText,
-            startTime: this.state.startTime,
-            endTime: getCurrTime(),
-        });
+        const times = { startTime: this.state.startTime, endTime: getCurrTime() };
+        const { wpm, accuracy } = await this.analyzer.send(
+            this.state.typedWords, promptedText,
+            { session: this.analyzer.session, ...times },
+            { promptedText, typedText, ...times },
+        );
         this.setState({ wpm, accuracy, currTime: getCurrTime() });
     };
 
     reportProgress = () => {
         const promptedText = this.state.promptedWords.join(" ");
-        post("/report_progress", {
-            id: this.state.id,
-            typed: this.state.typedWords.join(" "),
-            prompt: promptedText,
-        });
+        this.progressReporter.send(
+            this.state.typedWords, promptedText,
+            { id: this.state.id },
+            { id: this.state.id, typed: this.state.typedWords.join(" "), prompt: promptedText },
+        );
     };
 
-    requestProgress = async () => {
-        const progress = await post("/request_progress", {
-            targets: this.state.playerList,
-        });
+    // Each request waits on the server until a player reports new progress, so
+    // the next one can be sent as soon as it returns.
+    waitForProgress = async (loop, cursor) => {
+        if (loop !== this.multiplayerLoop) {
+            return;
+        }
+        let data;
+        try {
+            data = await post("/wait_for_progress", {
+                targets: this.state.playerList,
+                cursor,
+                game: this.state.game,
+            });
+        } catch (error) {
+            setTimeout(() => this.waitForProgress(loop, cursor), RETRY_DELAY);
+            return;
+        }
+        if (loop !== this.multiplayerLoop) {
+            return;
+        }
         this.setState({
-            progress,
+            progress: data.progress,
         });
-        if (progress.every(([x]) => x === 1.0)) {
-            clearInterval(this.multiplayerTimer);
+        if (data.progress.every(([x]) => x === 1.0)) {
+            this.multiplayerLoop = null;
             this.fastestWords();
+        } else {
+            this.waitForProgress(loop, data.cursor);
         }
     };
 
@@ -161,6 +198,7 @@ class App extends Component {
         const fastestWords = await post("/fastest_words", {
             targets: this.state.playerList,
             prompt: this.state.promptedWords.join(" "),
+            game: this.state.game,
         });
         this.setState({ fastestWords });
     };
@@ -193,17 +231,7 @@ class App extends Component {
 
         this.setState((state) => {
             if (state.autoCorrect && word !== state.promptedWords[wordIndex]) {
-                post("/autocorrect", { word }).then((data) => {
-                    // eslint-disable-next-line no-shadow
-                    this.setState((state) => {
-                        if (state.typedWords[wordIndex] !== word) {
-                            return {};
-                        }
-                        const { typedWords } = state;
-                        typedWords[wordIndex] = data;
-                        return { typedWords };
-                    });
-                });
+                this.queueCorrection(wordIndex, word);
             }
             return {
                 typedWords: state.typedWords.concat([word]),
@@ -214,6 +242,30 @@ class App extends Component {
         return true;
     };
 
+    queueCorrection = (wordIndex, word) => {
+        this.pendingCorrections.push([wordIndex, word]);
+        if (!this.correctionTimer) {
+            this.correctionTimer = setTimeout(this.sendCorrections, CORRECTION_DELAY);
+        }
+    };
+
+    // Autocorrects every word queued since the last batch in a single request.
+    sendCorrections = async () => {
+        const batch = this.pendingCorrections;
+        this.pendingCorrections = [];
+        this.correctionTimer = null;
+        const corrected = await post("/autocorrect_batch", { words: batch.map(([, word]) => word) });
+        this.setState((state) => {
+            const typedWords = state.typedWords.slice();
+            batch.forEach(([wordIndex, word], i) => {
+                if (typedWords[wordIndex] === word) {
+                    typedWords[wordIndex] = corrected[i];
+                }
+            });
+            return { typedWords };
+        });
+    };
+
     handleChange = async (currWord) => {
         this.setState({ currWord });
         if (this.state.typedWords.length + 1 === this.state.promptedWords.length
@@ -254,28 +306,43 @@ class App extends Component {
     setMode = (mode) => {
         this.setState({ mode });
         if (mode === Mode.WAITING) {
-            this.multiplayerTimer = setInterval(this.requestMatch, 1000);
+            this.multiplayerLoop = {};
+            this.waitForMatch(this.multiplayerLoop, null);
         }
     };
 
-    requestMatch = async () => {
-        const data = await post("/request_match", { id: this.state.id });
+    // Each request waits on the server until the game starts or the number of
+    // waiting players differs from numWaiting.
+    waitForMatch = async (loop, numWaiting) => {
+        if (loop !== this.multiplayerLoop) {
+            return;
+        }
+        let data;
+        try {
+            data = await post("/wait_for_match", { id: this.state.id, numWaiting });
+        } catch (error) {
+            setTimeout(() => this.waitForMatch(loop, numWaiting), RETRY_DELAY);
+            return;
+        }
+        if (loop !== this.multiplayerLoop) {
+            return;
+        }
         if (data.start) {
             this.setState({
                 mode: Mode.MULTI,
                 playerList: data.players,
+                game: data.game,
                 numPlayers: data.players.length,
                 promptedWords: data.text.split(" "),
                 progress: new Array(data.players.length).fill([0, 0]),
                 pigLatin: false,
                 autoCorrect: false,
-            });
-            clearInterval(this.multiplayerTimer);
-            this.multiplayerTimer = setInterval(this.requestProgress, 500);
+            }, () => this.waitForProgress(loop, null));
         } else {
             this.setState({
                 numPlayers: data.numWaiting,
             });
+            this.waitForMatch(loop, data.numWaiting);
         }
     };
 
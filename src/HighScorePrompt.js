@@ -20,9 +20,14 @@ export default function HighScorePrompt({
     }
 
     const requestChallenge = async () => {
-        const { images: receivedImages, token: receivedToken, lastWordLen: receivedLastWordLen } = await post("/request_wpm_challenge", {
+        const {
+            images: receivedImages, token: receivedToken, lastWordLen: receivedLastWordLen, message: failureMessage,
+        } = await post("/request_wpm_challenge", {
             user: Cookies.get("user"),
         });
+        if (!receivedImages.length) {
+            setMessage(`The server said: ${failureMessage} Please try again.`);
+        }
         setImages(receivedImages);
         setLastWordLen(receivedLastWordLen);
         token.current = receivedToken;
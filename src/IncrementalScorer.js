@@ -0,0 +1,56 @@
+import post from "./post";
+import { randomString } from "./utils";
+
+// Sends typed words to an incremental scoring route, which only needs the
+// words that changed since its last request. If the server no longer has the
+// session, or cannot score incrementally, the whole text is sent to the
+// fallback route instead. Requests are sent one at a time, in order.
+export default class IncrementalScorer {
+    constructor(route, fallbackRoute) {
+        this.route = route;
+        this.fallbackRoute = fallbackRoute;
+        this.session = randomString(16);
+        this.prompt = null;
+        this.sent = null; // The words the server has, or null to start over.
+        this.supported = true;
+        this.busy = false;
+        this.pending = Promise.resolve();
+    }
+
+    send(words, prompt, data, fallbackData) {
+        const result = this.pending.then(() => this.request(words, prompt, data, fallbackData));
+        this.pending = result.catch(() => {});
+        return result;
+    }
+
+    request = async (words, prompt, data, fallbackData) => {
+        this.busy = true;
+        try {
+            if (prompt !== this.prompt) {
+                this.prompt = prompt;
+                this.sent = null;
+            }
+            if (this.supported) {
+                const sent = this.sent || [];
+                let keep = 0;
+                while (keep < Math.min(words.length, sent.length) && words[keep] === sent[keep]) {
+                    keep += 1;
+                }
+                const request = { ...data, keep, added: words.slice(keep) };
+                if (this.sent === null) {
+                    request.prompt = prompt;
+                }
+                const response = await post(this.route, request);
+                if (response !== null) {
+                    this.sent = words.slice();
+                    return response;
+                }
+                this.supported = this.sent !== null;
+                this.sent = null;
+            }
+            return await post(this.fallbackRoute, fallbackData);
+        } finally {
+            this.busy = false;
+        }
+    };
+}
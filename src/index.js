@@ -31,12 +31,33 @@ document.body.prepend(new Comment(String.raw`
           (_/ (_/      ((_/
 `));
 
-post("/favicon").then((image) => {
-    document.querySelector("link[rel=\"shortcut icon\"]").href = image;
-});
-
 ReactDOM.render(<App />, document.getElementById("root"));
 
+// Favicons are kept in localStorage by ETag, so the server only sends images
+// that this browser has not seen before. Storage may be unavailable or hold
+// something unexpected, in which case favicons are just not cached.
+function loadFavicons() {
+    try {
+        const favicons = JSON.parse(localStorage.getItem("favicons"));
+        return favicons !== null && typeof favicons === "object" ? favicons : {};
+    } catch (error) {
+        return {};
+    }
+}
+
+const cachedFavicons = loadFavicons();
+post("/favicon", { cached: Object.keys(cachedFavicons) }).then(({ etag, image }) => {
+    if (image) {
+        cachedFavicons[etag] = image;
+        try {
+            localStorage.setItem("favicons", JSON.stringify(cachedFavicons));
+        } catch (error) {
+            // The image is still used for this page.
+        }
+    }
+    document.querySelector("link[rel=\"shortcut icon\"]").href = cachedFavicons[etag];
+});
+
 // If you want your app to work offline and load faster, you can change
 // unregister() to register() below. Note this comes with some pitfalls.
 // Learn more about service workers: https://bit.ly/CRA-PWA